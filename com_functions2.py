@@ -1,8 +1,10 @@
 import copy
 import logging
 import numpy as np
-from autoscript_sdb_microscope_client.structures import Point, StagePosition, AdornedImage
+from autoscript_sdb_microscope_client.structures import Point, StagePosition, AdornedImage, GrabFrameSettings, Rectangle
 import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
 
 ## Only for editing in VSCode. Remove before using?
 try:
@@ -10,17 +12,107 @@ try:
 except:
     pass
 
+class position_snapshot(tuple):
+    '''
+    One reading of all the stage axes (x, y, z, a, b), with the time t (s) it was taken.
+    Behaves as the tuple returned by current_position().
+    '''
+    def __new__(cls, position, t=None):
+        snapshot = super(position_snapshot, cls).__new__(cls, position)
+        snapshot.t = time.time() if t == None else t
+        return snapshot
+
+    def age(self):
+        return time.time() - self.t
+
+class move_future(object):
+    '''
+    Handle on one or several stage moves running in the background.
+
+    Exemple:
+        move = positioner.relative_move_async(da=2)
+        ... # save, register the previous frame
+        move.wait()
+        moves = move_future.combine(microscope.relative_move_async(dx=1e-6), positioner.relative_move_async(da=2))
+    '''
+    def __init__(self, *futures):
+        self.futures = []
+        for future in futures:
+            self.futures += future.futures if isinstance(future, move_future) else [future]
+
+    def done(self) -> bool:
+        return all([future.done() for future in self.futures])
+
+    def wait(self, timeout=None) -> int:
+        '''
+        Wait for all the moves. Return the worst status code of the moves (0 if all succeeded),
+        None on timeout. Exceptions raised by a move are raised here.
+        '''
+        _, not_done = wait(self.futures, timeout)
+        if len(not_done) > 0:
+            return None
+        return max([future.result() or 0 for future in self.futures] + [0])
+
+    @staticmethod
+    def combine(*moves):
+        return move_future(*moves)
+
 class microscope(object):
-    def __init__(self) -> None:
+    position_ttl = 0 # s, how long position() may reuse a reading
+    snapshot = None
+    move_executor = None
+
+    def __init__(self, acquisition_mode='backoff') -> None:
         # Test the microscope
+        # acquisition_mode: frame acquisition of the ESEM, 'grab', 'backoff' or 'poll'
         try:
             import DigitalMicrograph as DM
             microscope.f = FEI_TITAN_ETEM()
             microscope.p = microscope.f
         except:
-            microscope.f = FEI_QUATTRO_ESEM()
+            microscope.f = FEI_QUATTRO_ESEM(acquisition_mode)
             microscope.p = SMARACT_MCS_3D()
 
+    def invalidate_state(self, *keys):
+        # No client side state cache by default
+        pass
+
+    def position(self, ttl=None):
+        '''
+        Snapshot of the stage position: all the axes read at once, reused for ttl seconds
+        (position_ttl by default) unless a move invalidated it.
+
+        Exemple:
+            pos = positioner.position()
+            tangle = pos[3]
+        '''
+        ttl = self.position_ttl if ttl == None else ttl
+        snapshot = self.snapshot
+        if snapshot == None or snapshot.age() >= ttl:
+            snapshot = position_snapshot(self.current_position())
+            if snapshot[3] != None: # failed readings are not kept
+                self.snapshot = snapshot
+        return snapshot
+
+    def invalidate_position(self):
+        self.snapshot = None
+
+    def move_async(self, move, *args) -> move_future:
+        '''
+        Run a blocking move in the background and return its move_future.
+        Moves of one device run one after the other, in the order they were requested.
+        '''
+        if self.move_executor == None:
+            self.move_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='move')
+        self.invalidate_position()
+        return move_future(self.move_executor.submit(move, *args))
+
+    def relative_move_async(self, dx=0, dy=0, dz=0, da=0, db=0) -> move_future:
+        return self.move_async(self.relative_move, dx, dy, dz, da, db)
+
+    def absolute_move_async(self, x=None, y=None, z=None, a=None, b=None) -> move_future:
+        return self.move_async(self.absolute_move, x, y, z, a, b)
+
 
 class FEI_TITAN_ETEM(microscope):
     def __init__(self) -> None:
@@ -54,10 +146,12 @@ class FEI_TITAN_ETEM(microscope):
     def relative_move(self, dx, dy, dz, da, db, hold=True):
         x, y, z, a, b = DM.Py_Microscope().GetStagePositions(15)
         DM.Py_Microscope().SetStagePositions(15, x+dx*1e6, y+dy*1e6, z+dz*1e6, a+da, b+db)
+        self.invalidate_position()
         return 0
     
     def absolute_move(self, x, y, z, a, b):
         DM.Py_Microscope().SetStagePositions(15, x*1e6, y*1e6, z*1e6, a, b)
+        self.invalidate_position()
         return 0
     
     # Beam control
@@ -189,6 +283,20 @@ class FEI_TITAN_ETEM(microscope):
         img, _, _, _ = DM34.dm_load(path)
         return np.float32(img)
     
+    def frame_copy(self, image, array):
+        # The acquired DM image is refilled by the next acquisition: the saved copy holds the array of the frame
+        # with the calibration and the tags of the acquisition
+        copy = DM.CreateImage(array)
+        for dimension in range(image.GetNumDimensions()):
+            origin, scale, units = image.GetDimensionCalibration(dimension, 0)
+            copy.SetDimensionCalibration(dimension, origin, scale, units, 0)
+        copy.SetIntensityOrigin(image.GetIntensityOrigin())
+        copy.SetIntensityScale(image.GetIntensityScale())
+        copy.SetIntensityUnitString(image.GetIntensityUnitString())
+        copy.GetTagGroup().CopyTagsFrom(image.GetTagGroup())
+        copy.SetName(image.GetName())
+        return copy
+    
     def save(self, image, path):
         image.SaveAsGatan(path + '.dm4')
     
@@ -200,8 +308,19 @@ class FEI_TITAN_ETEM(microscope):
         return
 
 class FEI_QUATTRO_ESEM(microscope):
-    def __init__(self) -> None:
+    acquisition_modes = ('backoff', 'grab', 'poll')
+
+    def __init__(self, acquisition_mode='backoff') -> None:
         self.microscope_type = 'ESEM'
+        self.acquisition_mode = acquisition_mode # one of acquisition_modes
+        self.poll_min = 0.005 # s, shortest sleep between two get_image in 'backoff' mode
+        self.poll_max = 0.05 # s, longest sleep: latency bound after the end of a frame, long frames are better in 'grab' mode
+        self.frame_stats = {'frames': 0, 'rpcs': 0, 'bytes': 0}
+        self.state = {} # client side copy of the instrument settings, see cached()
+        self.state_lock = Lock()
+        self.state_rpcs = 0
+        self.beam_shift_limits_hfw = {}
+        self.beam_shift_stats = {'fast': 0, 'handoff': 0, 'handoff_time': 0, 'out_of_range': 0}
            
     # Packages & Connexion
     def import_package_and_connexion(self):
@@ -222,6 +341,50 @@ class FEI_QUATTRO_ESEM(microscope):
         except:
             pass
         
+    # Instrument state cache
+    def cached(self, key, read):
+        '''
+        Value of an instrument setting, read over RPC only if it is not in the cache.
+        Setters write through with cache_write(), anything that may change the settings
+        behind our back (auto functions, user on the microscope UI) calls invalidate_state().
+        '''
+        with self.state_lock:
+            if key not in self.state:
+                self.state[key] = read()
+                self.state_rpcs += 1
+            return self.state[key]
+
+    def cache_write(self, key, value, write):
+        with self.state_lock:
+            if key in self.state and self.state[key] == value:
+                return
+            write(value)
+            self.state[key] = value
+            self.state_rpcs += 1
+
+    def invalidate_state(self, *keys):
+        '''
+        Forget the cached settings (all of them if no key is given).
+        Exemple: invalidate_state('hfw') after a magnification change on the microscope UI.
+        '''
+        with self.state_lock:
+            if len(keys) == 0:
+                self.state.clear()
+            for key in keys:
+                self.state.pop(key, None)
+
+    def scan_settings(self, resolution, dwell_time, bit_depth, reduced_area=None):
+        scanning = self.quattro.beams.electron_beam.scanning
+        current = [self.cached('resolution', lambda: scanning.resolution.value),
+                   self.cached('dwell_time', lambda: scanning.dwell_time.value),
+                   self.cached('bit_depth', lambda: scanning.bit_depth)]
+        if current != [resolution, dwell_time, bit_depth]:
+            self.cache_write('resolution', resolution, lambda v: setattr(scanning.resolution, 'value', v))
+            self.cache_write('dwell_time', dwell_time, lambda v: setattr(scanning.dwell_time, 'value', v))
+            self.cache_write('bit_depth', bit_depth, lambda v: setattr(scanning, 'bit_depth', v))
+        if reduced_area != None:
+            self.cache_write('reduced_area', reduced_area, lambda v: scanning.mode.set_reduced_area(*v))
+
     # Stage Position & Move
     def current_position(self):
         # _, y, z, _, _, _ = self.quattro.specimen.stage.current_position()
@@ -231,18 +394,21 @@ class FEI_QUATTRO_ESEM(microscope):
     
     def relative_move(self, dx=0, dy=0, dz=0, da=0, db=0, hold=True):
         self.quattro.specimen.stage.relative_move(StagePosition(x=dx, y=dy, z=dz, r=da))
+        self.invalidate_position()
         return 0
     
     
     def absolute_move(self, x=None, y=None, z=None, a=None, b=None):
         self.quattro.specimen.stage.absolute_move(StagePosition(x=x, y=y, z=z, r=a))
+        self.invalidate_position()
         return 0
     
     # Beam control
     def horizontal_field_view(self, value:int=None):
+        hfw = self.quattro.beams.electron_beam.horizontal_field_width
         if value==None:
-            return self.quattro.beams.electron_beam.horizontal_field_width.value
-        self.quattro.beams.electron_beam.horizontal_field_width.value = value
+            return self.cached('hfw', lambda: hfw.value)
+        self.cache_write('hfw', value, lambda v: setattr(hfw, 'value', v))
     
     def magnification(self, value:int=None):
         pass
@@ -267,79 +433,149 @@ class FEI_QUATTRO_ESEM(microscope):
         elif value != None and mode != 'rel':
             self.quattro.beams.electron_beam.angular_correction.specimen_pretilt.value = value*np.pi/180
         
+    def beam_shift_limits(self):
+        '''
+        Beam shift limits (x_min, x_max, y_min, y_max) for the current horizontal field width.
+        The limits only depend on the HFW, they are read once per HFW value.
+        '''
+        hfw = self.horizontal_field_view()
+        with self.state_lock:
+            limits = self.beam_shift_limits_hfw.get(hfw, None)
+        if limits == None:
+            limits = self.quattro.beams.electron_beam.beam_shift.limits
+            limits = (limits.limits_x.min, limits.limits_x.max, limits.limits_y.min, limits.limits_y.max)
+            with self.state_lock:
+                self.beam_shift_limits_hfw[hfw] = limits
+                self.state_rpcs += 1
+        return limits, hfw
+
+    def beam_shift_handoff(self, x, y):
+        '''
+        Transfer a beam shift (x, y) out of range to the stage and reset the beam shift.
+        Slow path: stops the scan, moves the stage and waits for it to settle.
+        '''
+        t0 = time.perf_counter()
+        self.quattro.imaging.stop_acquisition()
+        logging.info('current_position' + str(self.current_position()))
+        self.relative_move(-x, -y)
+        logging.info('current_position' + str(self.current_position()))
+        self.cache_write('beam_shift', Point(0, 0), lambda v: setattr(self.quattro.beams.electron_beam.beam_shift, 'value', v))
+        time.sleep(1)
+        self.quattro.imaging.start_acquisition()
+        self.beam_shift_stats['handoff'] += 1
+        self.beam_shift_stats['handoff_time'] += time.perf_counter() - t0
+        logging.info('Beam shift + stage: ' + str(round(time.perf_counter() - t0, 3)) + ' s')
+
     def beam_shift(self, value_x:float=None, value_y:float=None, mode:str=None):
+        '''
+        Beam shift controller. The current shift and the limits are tracked on the client side
+        (see cached()), so a correction that stays inside the limits costs one RPC.
+        Out of range, the shift is handed off to the stage if y stays within one HFW.
+        '''
+        electron_beam = self.quattro.beams.electron_beam
         if value_x==None or value_y==None:
-            return self.quattro.beams.electron_beam.beam_shift.value
+            return self.cached('beam_shift', lambda: electron_beam.beam_shift.value)
         
-        limits = self.quattro.beams.electron_beam.beam_shift.limits
-        limit_x_min = limits.limits_x.min
-        limit_x_max = limits.limits_x.max
-        limit_y_min = limits.limits_y.min
-        limit_y_max = limits.limits_y.max
-
-        limits_extra = self.quattro.beams.electron_beam.horizontal_field_width.value
+        (limit_x_min, limit_x_max, limit_y_min, limit_y_max), limits_extra = self.beam_shift_limits()
 
         if mode == 'rel':
-            actual_shift_x, actual_shift_y = self.quattro.beams.electron_beam.beam_shift.value
+            actual_shift_x, actual_shift_y = self.beam_shift()
             x = actual_shift_x + value_x
             y = actual_shift_y + value_y
-            if limit_x_min < x < limit_x_max and limit_y_min < y < limit_y_max:
-                shift = Point(x, y)
-                self.quattro.beams.electron_beam.beam_shift.value = shift
-                logging.info('Only beam shift')
-                return
-            elif -limits_extra < y < limits_extra:
-                self.quattro.imaging.stop_acquisition()
-                logging.info('current_position' + str(self.current_position()))
-                logging.info('value_x' + str(value_x))
-                self.relative_move(-x, -y)
-                logging.info('current_position' + str(self.current_position()))
-                shift = Point(0, 0)
-                self.quattro.beams.electron_beam.beam_shift.value = shift
-                time.sleep(1)
-                self.quattro.imaging.start_acquisition()
-                logging.info('Beam shift + stage')
-                return
-            else:
-                logging.info('Beam shift out of range. Actual shift y + value = ', y)
-                return
         else:
-            if limit_x_min < value_x < limit_x_max and limit_y_min < value_y < limit_y_max:
-                shift = Point(value_x, value_y)
-                self.quattro.beams.electron_beam.beam_shift.value = shift
-                return
-            elif -limits_extra < value_y < limits_extra:
-                self.quattro.imaging.stop_acquisition()
-                self.relative_move(-x, -y)
-                shift = Point(0, 0)
-                self.quattro.beams.electron_beam.beam_shift.value = shift
-                time.sleep(1)
-                self.quattro.imaging.start_acquisition()
-                logging.info('Beam shift + stage')
-                return
-            else:
-                logging.info('Beam shift out of range')
-                return
+            x = value_x
+            y = value_y
+
+        if limit_x_min < x < limit_x_max and limit_y_min < y < limit_y_max:
+            self.cache_write('beam_shift', Point(x, y), lambda v: setattr(electron_beam.beam_shift, 'value', v))
+            self.beam_shift_stats['fast'] += 1
+            logging.info('Only beam shift')
+            return
+        elif -limits_extra < y < limits_extra:
+            self.beam_shift_handoff(x, y)
+            return
+        else:
+            self.beam_shift_stats['out_of_range'] += 1
+            logging.info('Beam shift out of range. Actual shift y + value = ' + str(y))
+            return
             
     # Imaging
     def image_settings(self):
-        resolution = self.quattro.beams.electron_beam.scanning.resolution.value
-        dwell_time = self.quattro.beams.electron_beam.scanning.dwell_time.value
+        scanning = self.quattro.beams.electron_beam.scanning
+        resolution = self.cached('resolution', lambda: scanning.resolution.value)
+        dwell_time = self.cached('dwell_time', lambda: scanning.dwell_time.value)
         return resolution, dwell_time
     
     def get_image(self):
         pass
     
+    def frame_time(self, resolution, dwell_time, width=1):
+        # Expected scan time of one frame (flyback not included)
+        image_width, image_height = resolution.split('x')
+        return int(image_width)*width*int(image_height)*dwell_time
+
+    def frame_cost(self, rpcs, nbytes):
+        # Client side accounting of what one frame costs on the ORC link
+        self.frame_stats['frames'] += 1
+        self.frame_stats['rpcs']   += rpcs
+        self.frame_stats['bytes']  += nbytes
+        logging.info('Frame ' + str(self.frame_stats['frames']) + ' (' + self.acquisition_mode + '): ' + str(rpcs) + ' RPCs, ' + str(nbytes) + ' bytes')
+
+    def frame_statistics(self):
+        frames = max(self.frame_stats['frames'], 1)
+        return {'mode': self.acquisition_mode,
+                'frames': self.frame_stats['frames'],
+                'rpcs_per_frame': self.frame_stats['rpcs']/frames,
+                'bytes_per_frame': self.frame_stats['bytes']/frames}
+
+    def backoff_delay(self, delay, elapsed, frame_time):
+        '''
+        Sleep before the next transfer in 'backoff' mode: the doubling delay, capped at poll_max and cut at
+        the expected end of the frame, then poll_min once the frame should be complete.
+        A frame is thus seen at most poll_max after it ends (poll_min around the expected end).
+        '''
+        remaining = frame_time - elapsed
+        if remaining <= 0:
+            return self.poll_min
+        return max(self.poll_min, min(delay, self.poll_max, remaining))
+
+    def wait_new_frame(self, img_prev_stamp, frame_time):
+        '''
+        Poll the active view until the last line of the image changes.
+        
+        'poll':    legacy busy loop, one image transfer per iteration.
+        'backoff': sleeps between transfers, starting at frame_time/16 and doubling up to poll_max until the
+                   expected end of the frame, then every poll_min: a few transfers per frame, at most poll_max late.
+        
+        Output:
+            - image (AdornedImage), number of RPCs, number of bytes transferred
+        '''
+        rpcs, nbytes = 0, 0
+        delay = max(self.poll_min, frame_time/16)
+        t_start = time.time()
+        while (True):
+            if self.acquisition_mode == 'backoff':
+                time.sleep(self.backoff_delay(delay, time.time() - t_start, frame_time))
+                delay = 2*delay
+            img = self.quattro.imaging.get_image()
+            rpcs += 1
+            try:
+                nbytes += img.data.nbytes
+                if not np.array_equal(img_prev_stamp, img.data[-1,:]):
+                    return img, rpcs, nbytes
+            except:
+                logging.info('Error acquiring frame')
+                pass
+
     def acquire_frame(self, resolution='1024x884', dwell_time=1e-6, bit_depth=16, square_area=False):
-        img = self.quattro.imaging.get_image()
-        img_prev_stamp = img.data[-1,:]
-        micro_resolution = self.quattro.beams.electron_beam.scanning.resolution.value
-        micro_dwell_time = self.quattro.beams.electron_beam.scanning.dwell_time.value
-        micro_bit_depth = self.quattro.beams.electron_beam.scanning.bit_depth
-        if [micro_resolution, micro_dwell_time, micro_bit_depth] != [resolution, dwell_time, bit_depth]:
-            self.quattro.beams.electron_beam.scanning.resolution.value = resolution
-            self.quattro.beams.electron_beam.scanning.dwell_time.value = dwell_time
-            self.quattro.beams.electron_beam.scanning.bit_depth = bit_depth
+        '''
+        Acquire one new frame in the active view.
+        
+        acquisition_mode:
+            - 'grab':    single GrabFrame RPC with GrabFrameSettings (the live scan is paused afterwards),
+            - 'backoff': next frame of the live scan, polled according to the expected frame time,
+            - 'poll':    next frame of the live scan, busy polled (legacy).
+        '''
         if square_area == True:
             image_width, image_height = resolution.split('x')
             image_width, image_height = int(image_width), int(image_height)
@@ -349,20 +585,38 @@ class FEI_QUATTRO_ESEM(microscope):
             top = 0
             width = dim_min/dim_max
             height = 1
-            self.quattro.beams.electron_beam.scanning.mode.set_reduced_area(left, top, width, height)
+        else:
+            width = 1
+
+        if self.acquisition_mode == 'grab':
+            reduced_area = Rectangle(left, top, width, height) if square_area == True else None
+            settings = GrabFrameSettings(resolution=resolution, dwell_time=dwell_time, bit_depth=bit_depth, reduced_area=reduced_area)
+            img = self.quattro.imaging.grab_frame(settings)
+            self.invalidate_state('resolution', 'dwell_time', 'bit_depth', 'reduced_area')
+            self.frame_cost(1, img.data.nbytes)
+            return img
+
+        state_rpcs = self.state_rpcs
+        img = self.quattro.imaging.get_image()
+        img_prev_stamp = img.data[-1,:]
+        nbytes = img.data.nbytes
+        self.scan_settings(resolution, dwell_time, bit_depth, (left, top, width, height) if square_area == True else None)
         
-        while (True):
-            img = self.quattro.imaging.get_image()
-            try:
-                if not np.array_equal(img_prev_stamp, img.data[-1,:]):
-                    return img
-            except:
-                logging.info('Error acquiring frame')
-                pass
+        img, poll_rpcs, poll_bytes = self.wait_new_frame(img_prev_stamp, self.frame_time(resolution, dwell_time, width))
+        self.frame_cost(1 + self.state_rpcs - state_rpcs + poll_rpcs, nbytes + poll_bytes)
+        return img
     
     def acquire_multiple_frames(self, resolution='1536x1024', dwell_time=1e-6, bit_depth=16, windows='123'):        
         windows         = [int(s) for s in windows]
 
+        if self.acquisition_mode == 'grab':
+            # One frame per compatible view, in view order
+            settings = GrabFrameSettings(resolution=resolution, dwell_time=dwell_time, bit_depth=bit_depth)
+            imgs = self.quattro.imaging.grab_multiple_frames(settings)
+            self.invalidate_state('resolution', 'dwell_time', 'bit_depth', 'reduced_area')
+            self.frame_cost(1, sum([img.data.nbytes for img in imgs]))
+            return imgs
+
         imgs            = [0]*len(windows)
         img_prev_stamp  = []
         
@@ -371,27 +625,32 @@ class FEI_QUATTRO_ESEM(microscope):
         ind = windows.index(view)
         imgs[ind] = self.quattro.imaging.get_image()
         img_prev_stamp = imgs[ind].data[-1,:]
+        state_rpcs = self.state_rpcs
+        self.scan_settings(resolution, dwell_time, bit_depth)
+        rpcs, nbytes = 3 + self.state_rpcs - state_rpcs, imgs[ind].data.nbytes
 
-        micro_resolution = self.quattro.beams.electron_beam.scanning.resolution.value
-        micro_dwell_time = self.quattro.beams.electron_beam.scanning.dwell_time.value
-        micro_bit_depth = self.quattro.beams.electron_beam.scanning.bit_depth
-        if [micro_resolution, micro_dwell_time, micro_bit_depth] != [resolution, dwell_time, bit_depth]:
-            self.quattro.beams.electron_beam.scanning.resolution.value = resolution
-            self.quattro.beams.electron_beam.scanning.dwell_time.value = dwell_time
-            self.quattro.beams.electron_beam.scanning.bit_depth = bit_depth
-
+        frame_time = self.frame_time(resolution, dwell_time)
+        delay = max(self.poll_min, frame_time/16)
+        t_start = time.time()
         while (True):
+            if self.acquisition_mode == 'backoff':
+                time.sleep(self.backoff_delay(delay, time.time() - t_start, frame_time))
+                delay = 2*delay
             imgs[ind] = self.quattro.imaging.get_image()
             view2 = self.quattro.imaging.get_active_view()
+            rpcs, nbytes = rpcs + 2, nbytes + imgs[ind].data.nbytes
             if view != view2:
                 view = copy.deepcopy(view2)
                 ind = windows.index(view)
                 imgs[ind] = self.quattro.imaging.get_image()
                 img_prev_stamp = imgs[ind].data[-1,:]
+                rpcs, nbytes = rpcs + 1, nbytes + imgs[ind].data.nbytes
             if not (img_prev_stamp == imgs[ind].data[-1,:]).all():
                 for j in range(len(windows)):
                     self.quattro.imaging.set_active_view(windows[j])
                     imgs[j] = self.quattro.imaging.get_image()
+                    rpcs, nbytes = rpcs + 2, nbytes + imgs[j].data.nbytes
+                self.frame_cost(rpcs, nbytes)
                 return imgs
     
     def image_array(self, image):
@@ -412,7 +671,9 @@ class FEI_QUATTRO_ESEM(microscope):
             return self.quattro.beams.electron_beam.unblank()
     
     def auto_contrast_brightness(self):
-        return self.quattro.auto_functions.run_auto_cb()
+        result = self.quattro.auto_functions.run_auto_cb()
+        self.invalidate_state()
+        return result
     
     def start_acquisition(self):
         return self.quattro.imaging.start_acquisition()
@@ -442,14 +703,38 @@ class SMARACT_MCS_3D(microscope):
     
     def relative_move(self, dx=0, dy=0, dz=0, da=0, db=0, hold=True):
         self.positioner.setpos_rel([dz*1e9, dy*1e9, da*1e6], hold)
+        self.invalidate_position()
         return 0
     
     def relative_detector_move(self, ddx=0, ddy=0, hold=True):
         self.positioner.detector_setpos_rel([ddx*1e9, ddy*1e9], hold)
         return 0
+
+    def relative_detector_move_async(self, ddx=0, ddy=0) -> move_future:
+        return self.move_async(self.relative_detector_move, ddx, ddy)
+
+    def rotate(self, a_end, velocity) -> move_future:
+        '''
+        Continuous tilt to a_end (degrees) at a constant velocity (degrees/s), in the background.
+        The previous tilt velocity is restored at the end of the rotation.
+        '''
+        def rotation():
+            velocity_previous = self.positioner.get_velocity(0)
+            self.positioner.set_velocity(0, abs(velocity)*1e9)
+            try:
+                return self.positioner.setpos_tilt(a_end*1e6, hold=True)
+            finally:
+                self.positioner.set_velocity(0, velocity_previous)
+        return self.move_async(rotation)
+
+    def stop(self):
+        self.positioner.stop()
+        self.invalidate_position()
     
     def absolute_move(self, x=None, y=None, z=None, a=None, b=None, hold=True):
-        return self.positioner.setpos_abs([z*1e9, y*1e9, a*1e6])
+        status = self.positioner.setpos_abs([z*1e9, y*1e9, a*1e6])
+        self.invalidate_position()
+        return status
 
     def absolute_detector_move(self, dx=None, dy=None, hold=True):
         return self.positioner.detector_setpos_abs([dx*1e9, dy*1e9], hold)
@@ -238,7 +238,10 @@ class App(object):
         text2  = tk.StringVar(master=self.frm_sav, value='70')
         text3  = tk.StringVar(master=self.frm_sav, value='Acquisition')
         self.check1 = tk.BooleanVar(value=False)
+        self.check3 = tk.BooleanVar(value=False)
+        self.check4 = tk.BooleanVar(value=False)
         self.check2 = tk.BooleanVar(value=False)
+        self.check5 = tk.BooleanVar(value=False)
         self.ent_tilt_step = tk.Entry(      master=self.frm_sav, width=20, bg='#2B2B2B', fg='white', textvariable=text1, justify='left')
         self.ent_end_tilt  = tk.Entry(      master=self.frm_sav, width=20, bg='#2B2B2B', fg='white', textvariable=text2, justify='left')
         self.ent_name      = tk.Entry(      master=self.frm_sav, width=20, bg='#2B2B2B', fg='white', textvariable=text3, justify='left')
@@ -256,6 +259,32 @@ class App(object):
         self.check_drift.place(x=20, y=140)
         self.check_focus.place(x=180, y=140)
 
+        self.lbl_drift_backend = tk.Label(master=self.frm_sav, width=20, height=1, bg='#2B2B2B', fg='white', text="Drift method", justify='left')
+        self.ent_drift_backend = tk.Spinbox(master=self.frm_sav, width=14, bg='#2B2B2B', readonlybackground='#2B2B2B', fg='white', values=tuple(scripts.drift_backends), justify='center', state='readonly', wrap=True)
+        self.check_scheduler = tk.Checkbutton(master=self.frm_sav, width=17, bg='#2B2B2B', fg='white', activebackground='#2B2B2B', activeforeground='white', selectcolor="#2B2B2B", variable=self.check3, onvalue=True, offvalue=False, text="  Overlapped stages")
+        self.check_scheduler.place(x=350, y=60)
+        self.check_continuous = tk.Checkbutton(master=self.frm_sav, width=17, bg='#2B2B2B', fg='white', activebackground='#2B2B2B', activeforeground='white', selectcolor="#2B2B2B", variable=self.check4, onvalue=True, offvalue=False, text="  Continuous tilt")
+        self.check_continuous.place(x=350, y=20)
+        self.lbl_drift_backend.place(x=350, y=100)
+        self.ent_drift_backend.place(x=350, y=140)
+
+        self.lbl_denoiser = tk.Label(master=self.frm_sav, width=20, height=1, bg='#2B2B2B', fg='white', text="Pre-match filter", justify='left')
+        self.ent_denoiser = tk.Spinbox(master=self.frm_sav, width=14, bg='#2B2B2B', readonlybackground='#2B2B2B', fg='white', values=tuple(scripts.denoisers), justify='center', state='readonly', wrap=True)
+        self.lbl_denoiser.place(x=350, y=180)
+        self.ent_denoiser.place(x=350, y=220)
+
+        # Frame acquisition of the ESEM, the ETEM has a single mode
+        self.acquisition_mode = tk.StringVar(master=self.frm_sav)
+        self.lbl_acquisition_mode = tk.Label(master=self.frm_sav, width=20, height=1, bg='#2B2B2B', fg='white', text="Frame acquisition", justify='left')
+        self.ent_acquisition_mode = tk.Spinbox(master=self.frm_sav, width=14, bg='#2B2B2B', readonlybackground='#2B2B2B', fg='white', values=getattr(self.microscope, 'acquisition_modes', ('single',)), textvariable=self.acquisition_mode, justify='center', state='readonly', wrap=True)
+        self.acquisition_mode.set(getattr(self.microscope, 'acquisition_mode', 'single'))
+        self.lbl_acquisition_mode.place(x=350, y=260)
+        self.ent_acquisition_mode.place(x=350, y=300)
+
+        # Frame N registered while frame N+1 is acquired, the features extracted in worker processes
+        self.check_pipeline = tk.Checkbutton(master=self.frm_sav, width=17, bg='#2B2B2B', fg='white', activebackground='#2B2B2B', activeforeground='white', selectcolor="#2B2B2B", variable=self.check5, onvalue=True, offvalue=False, text="  Pipelined drift")
+        self.check_pipeline.place(x=350, y=340)
+
         self.btn_acquisition = tk.Button(master=self.frm_sav, width=20, height=1, bg='#373737', fg='white', text="Start Acquisition", justify='left', command=self.acquisition)
         self.btn_acquisition.place(x=100, y=240)
         
@@ -291,10 +320,10 @@ class App(object):
         self.lbl_eucent.update()
 
         if self.microscope.microscope_type == 'ESEM':
-            self.eucentric_ESEM = threading.Thread(target=scripts.set_eucentric, args=(self.microscope, self.positioner))
+            self.eucentric_ESEM = threading.Thread(target=scripts.set_eucentric, args=(self.microscope, self.positioner, self.ent_drift_backend.get()))
             self.eucentric_ESEM.start()
         else:
-            set_eucentric_status = scripts.set_eucentric(self.microscope, self.positioner)
+            set_eucentric_status = scripts.set_eucentric(self.microscope, self.positioner, self.ent_drift_backend.get())
         
         # if set_eucentric_status == 0:
         #     self.lbl_eucent.config(bg='green')
@@ -445,6 +474,11 @@ class App(object):
     #     self.btn_zero_eucentric.config(state=tk.NORMAL)
     #     self.btn_folder1.config(state=tk.NORMAL)
         
+    def set_acquisition_mode(self):
+        if hasattr(self.microscope, 'acquisition_modes'):
+            self.microscope.acquisition_mode = self.acquisition_mode.get()
+            logging.info('frame acquisition = ' + self.microscope.acquisition_mode)
+
     def acquisition(self):
         self.lbl_acquisition.config(bg="green")
         self.lbl_acquisition.update()
@@ -452,6 +486,8 @@ class App(object):
         try:
             global imgID
             imgID = 0
+            self.microscope.invalidate_state() # settings may have been changed on the microscope UI
+            self.set_acquisition_mode()
             self.acqui = scripts.acquisition(self.microscope,
                                           self.positioner,
                                           work_folder = 'data/tomo/',
@@ -463,7 +499,12 @@ class App(object):
                                           tilt_end = int(self.ent_end_tilt.get()),
                                           drift_correction = self.check1.get(),
                                           focus_correction = self.check2.get(),
-                                          square_area = True)
+                                          square_area = True,
+                                          drift_backend = self.ent_drift_backend.get(),
+                                          denoiser = self.ent_denoiser.get(),
+                                          pipeline = self.check5.get(),
+                                          scheduler = self.check3.get(),
+                                          continuous = self.check4.get())
 
             self.thread_tomo = threading.Thread(target = self.acqui.tomo)
             self.thread_tomo.start()
@@ -488,6 +529,8 @@ class App(object):
         self.lbl_record.config(bg='green')
         self.lbl_record.update()
         # try:
+        self.microscope.invalidate_state() # settings may have been changed on the microscope UI
+        self.set_acquisition_mode()
         self.acqui = scripts.acquisition(self.microscope,
                                     self.positioner,
                                     work_folder = 'data/record/',
@@ -499,7 +542,10 @@ class App(object):
                                     tilt_end = int(self.ent_end_tilt.get()),
                                     drift_correction = self.check1.get(),
                                     focus_correction = self.check2.get(),
-                                    square_area = False)
+                                    square_area = False,
+                                    drift_backend = self.ent_drift_backend.get(),
+                                    denoiser = self.ent_denoiser.get(),
+                                    pipeline = self.check5.get())
         time.sleep(0.1)
         self.thread_acqui = threading.Thread(target = self.acqui.record)
         self.thread_acqui.start()
@@ -557,6 +603,11 @@ class App(object):
             # except:
             #     pass
 
+            # Frames still queued for saving are written before the stop returns
+            self.acqui.stop_writer()
+            scripts.features_pipeline.shutdown()
+            scripts.diagnostics.flush()
+
         self.lbl_eucent.config(bg='red')
         self.lbl_eucent.update()
         self.lbl_acquisition.config(bg="red")
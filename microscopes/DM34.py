@@ -6,24 +6,56 @@ can be used under
 GNU Lesser General Public License  
 """
 
+import os
+import mmap as mm
 import numpy as np
 import struct
 
 
-def dm_load(filename,index =0,prt =False) ->tuple:    
+def dm_load(filename,index =0,prt =False,mmap =False,metadata =True) ->tuple:    
         #index shows which image is needed,prt: print intermediate output
+        #mmap: image as a copy-on-write np.memmap, pages are read only when touched
+        #metadata: False to jump over the ImageTags groups (dm4), metadata is then None
     with open(filename, "rb") as f:
-        dm = read_DM(f,prt) #initialize red class
+        dm = read_DM(f,prt,mmap,skip =() if metadata else ('ImageTags',)) #initialize red class
         dm.read_file() #read as dictionary
         
         dm.make_image_list() #extract images, remove thumbnail
         image,dimensions,calibration =dm.get_data_array(index)#output image[index],calibration
         metadata =dm.get_matadata(index) #output metadata
         
+        dm.close()
         f.close()
         
         return image,dimensions,calibration,metadata
 
+dm_index_cache ={} #filename: (modification time, size, dm_ext, endian, offset index) for dm_tag
+dm_index_cache_size =256
+
+def dm_tag(filename,path:str):
+        #value of one Tag or TagGroup, path as 'ImageList/1/ImageTags/Microscope Info/Voltage'
+        #(file numbering of ImageList, thumbnail included)
+        #the offset index of a file is built once, metadata subtrees are added when first looked up
+    stat =os.stat(filename)
+    entry =dm_index_cache.get(filename)
+    with open(filename, "rb") as f:
+        dm = read_DM(f,False,mmap =True,skip =('ImageTags',))
+        if entry is None or entry[:2] !=(stat.st_mtime,stat.st_size):
+            dm.read_file() #header-only pass, builds dm.offsets
+            entry =(stat.st_mtime,stat.st_size,dm.dm_ext,dm.endian,dm.offsets)
+            dm_index_cache[filename] =entry
+            if len(dm_index_cache) >dm_index_cache_size:
+                del dm_index_cache[next(iter(dm_index_cache))] #oldest file
+        else:
+            dm.open_buffer()
+            dm.dm_ext,dm.endian,dm.offsets =entry[2:]
+            dm.init_structs()
+        value =dm.lookup(path)
+        dm.close()
+        f.close()
+        
+        return value
+
 def dm_load_as_tags(filename,index =0) ->dict:   #for testing purpose 
    
     with open(filename, "rb") as f:
@@ -49,7 +81,7 @@ def dm_store(filename,Image,dimensions:dict,dm_ext:str,calibration=None,meta=Non
     with open(filename, "wb") as f:
         f.write(dm.b_header) #write file header
         f.write(dm.b_before) #write part before image
-        f.write(Image.tobytes()) #write image
+        f.write(image_buffer(Image)) #write image, from the array memory
         f.write(dm.b_after) #write part after image
         f.write(set_uint64(0,'little')) #write 8 zero bytes (end marker)
         
@@ -70,6 +102,22 @@ def dm_store_must_tags(Image,dimensions:dict,dm_ext:str,calibration=None,meta=No
 
 
 
+def strip_sorted(value):
+    """
+    TagGroup without the 'sorted' keys added by the parser (as returned by dm_load)
+    """
+    if isinstance(value,dict):
+        return {key:strip_sorted(item) for key,item in value.items() if key !='sorted'}
+    return value
+
+
+def image_buffer(Image):
+    """
+    bytes of the image in C order, without copy when the array is already contiguous
+    """
+    return memoryview(np.ascontiguousarray(Image)).cast('B')
+
+
 """
 ELEMENTAL READING BLOCKS
 """
@@ -242,13 +290,33 @@ def tag_counts() ->tuple:
 
 
 
+"""
+PRECOMPILED READING BLOCKS
+headers are big endian whatever the byte ordering of the file
+"""
+
+header_int8 =struct.Struct('>b')
+header_uint8 =struct.Struct('>B')
+header_int16 =struct.Struct('>h')
+header_uint16 =struct.Struct('>H')
+header_int32 =struct.Struct('>l')
+header_int64 =struct.Struct('>q')
+header_uint64 =struct.Struct('>Q')
+
+
 """
 CLASS read dm file
 """ 
 class read_DM(object):
 
-    def __init__(self,f,prt):
+    def __init__(self,f,prt,mmap =False,skip =()):
         self.f = f      #file stream
+        self.mmap = mmap #parse from a memory map of the file instead of reading it
+        self.skip = skip #names of the Tags/TagGroups jumped over (dm4 only, they store their length)
+        self.offsets = {} #offset index, tag path: offset of its name header
+        self.map = None
+        self.buf = None #whole file as a memoryview, the tags are parsed from it
+        self.pos = 0    #current offset in buf
         self.dm_ext = None  #3 or 4
         self.endian = None  #usually little
         self.tags_dict={}   #main dictionary to store all dm info
@@ -271,12 +339,67 @@ class read_DM(object):
         self.type_dict_DM[20] =(None,'array','array',self.read_array,None,None,0) 
 
 
+    def init_structs(self):
+        """
+        precompiled unpackers of the numbers stored with the byte ordering of the file
+        """
+        end =set_endian(self.endian)
+        self.struct_DM ={}
+        for code,v in self.type_dict_DM.items():
+            if v[3] is get_char:
+                self.struct_DM[code] =struct.Struct(end+'c')
+            elif v[1] in NP_number_types() and v[3] is not None:
+                self.struct_DM[code] =struct.Struct(end+v[2])
+        
+
     def read_file(self):
-        self.f.seek(0)
+        self.open_buffer()
         self.file_header()
+        self.init_structs()
         self.parse_tags_to_dict(group_name="", group_dict=self.tags_dict,root =True)
         
         
+    def open_buffer(self):
+        self.f.seek(0)
+        if self.mmap:
+            self.map =mm.mmap(self.f.fileno(),0,access =mm.ACCESS_READ) #only the tag pages are read
+            self.buf =memoryview(self.map)
+        else:
+            self.buf =memoryview(self.read_buffer())
+        self.pos =0
+
+
+    def read_buffer(self) ->bytearray:
+        """
+        one bulk read of the file, into a writable buffer: the image array is a view of it
+        """
+        try:
+            size =os.fstat(self.f.fileno()).st_size -self.f.tell()
+        except (AttributeError, OSError): #stream without file descriptor (BytesIO...)
+            return bytearray(self.f.read())
+        buffer =bytearray(size)
+        self.f.readinto(buffer)
+        return buffer
+
+
+    def close(self):
+        """
+        release the file buffer (arrays already returned stay valid)
+        """
+        if self.buf is not None:
+            self.buf.release()
+        if self.map is not None:
+            self.map.close()
+        self.buf =None
+        self.map =None
+
+
+    def unpack(self,unpacker:struct.Struct):
+        value =unpacker.unpack_from(self.buf,self.pos)[0]
+        self.pos +=unpacker.size
+        return value
+
+
     def file_header(self):
         """
         Read dm format (extension) and endian
@@ -284,11 +407,11 @@ class read_DM(object):
         2:length in bytes
         3: endian, 0-big, 1-little (only for INSIDE tags)
         """
-        self.dm_ext = get_int32(self.f, "big")
+        self.dm_ext = self.unpack(header_int32)
 
         length =self.read_DMvalue() #total file length (not used)
         
-        byte_ordering = get_int32(self.f, "big")
+        byte_ordering = self.unpack(header_int32)
         if self.print: print('dm',self.dm_ext," length ",length, " ordering ",byte_ordering)
         
         if bool(byte_ordering):
@@ -303,9 +426,9 @@ class read_DM(object):
         diferent formats for dm3 and dm4
         """
         if self.dm_ext ==4:
-            return get_int64(self.f, "big")
+            return self.unpack(header_int64)
         else:
-            return get_int32(self.f, "big")
+            return self.unpack(header_int32)
         
         
     def group_header(self, group_name ='',root=False) ->tuple:
@@ -318,9 +441,9 @@ class read_DM(object):
         """
         l_group =0
         if self.dm_ext ==4 and root ==False:
-            l_group =get_uint64(self.f, "big")
-        is_sorted = get_int8(self.f, "big")
-        is_open = get_int8(self.f, "big")
+            l_group =self.unpack(header_uint64)
+        is_sorted = self.unpack(header_int8)
+        is_open = self.unpack(header_int8)
         n_tags = self.read_DMvalue()
         
         return bool(is_sorted), bool(is_open), n_tags, l_group
@@ -333,8 +456,8 @@ class read_DM(object):
         2:length of tag name
         3:tag_name - names of Tag or TagGroup
         """
-        tag_code = get_int8(self.f, "big")
-        tag_name_length = get_int16(self.f, "big")
+        tag_code = self.unpack(header_int8)
+        tag_name_length = self.unpack(header_int16)
         tag_name = self.read_string(tag_name_length)
         
         if tag_code ==21: self.check_delimiter(3) #check the tag marker
@@ -344,25 +467,27 @@ class read_DM(object):
     
     def check_delimiter(self,deviation:int):
         #check if the tag marker is at right place after the name tag
+        start =self.pos
         if self.dm_ext ==4:
-            get_int64(self.f, "big")
-        marker =self.read_string(4) #read '%%%%' marker   
-        if marker != '%%%%': #name length can be inaccurate!
-            if self.print: print('marker:',marker)          
-            self.f.seek(-(4+deviation), 1) #set stream back
+            self.pos +=8
+        if self.buf[self.pos:self.pos+4] != b'%%%%': #name length can be inaccurate!
+            if self.print: print('marker:',bytes(self.buf[self.pos:self.pos+4]))          
+            self.pos -=deviation #set stream back
         
             markers =0 #markers count
             #find th eright position
             for i in range(4+2*deviation):    
-                ch =self.read_string(1) #read '%' marker
-                if self.print: print(ch) 
-                if ch =='%':
+                ch =self.buf[self.pos:self.pos+1] #read '%' marker
+                self.pos +=1
+                if self.print: print(bytes(ch)) 
+                if ch ==b'%':
                     markers +=1
                     if markers ==4: break
-                
-        #return to the right end of name tag
-        self.f.seek(-4, 1)
-        if self.dm_ext ==4: self.f.seek(-8, 1)
+            #return to the right end of name tag
+            self.pos -=4
+            if self.dm_ext ==4: self.pos -=8
+        else:
+            self.pos =start
     
                 
     def tag_header(self) ->tuple:
@@ -374,104 +499,161 @@ class read_DM(object):
         """
         tag_length =0
         if self.dm_ext ==4: #tag lengh is stored in dm4 only
-            tag_length =get_int64(self.f, "big")
+            tag_length =self.unpack(header_int64)
             
-        self.read_string(4) #read '%%%%' marker                
+        self.pos +=4 #skip '%%%%' marker                
         length_definitions =self.read_DMvalue()
         
         return length_definitions,tag_length
     
         
      
-    def parse_tags_to_dict(self,group_name:str, group_dict:dict,root=False):
+    def parse_tags_to_dict(self,group_name:str, group_dict:dict,root=False,path=''):
         """
         recursive funcion to scroll through DM file tags structure
+        the offset of every tag met is stored in self.offsets under its path (names joined by '/')
         """
         is_sorted,is_open,n_tags,l_group =self.group_header(group_name=group_name,root=root)       
 
-        if self.print: print('group sorted/open:',is_sorted,is_open,'length',l_group,'offset',self.f.tell(),"number of tags ",n_tags)
+        if self.print: print('group sorted/open:',is_sorted,is_open,'length',l_group,'offset',self.pos,"number of tags ",n_tags)
         if is_sorted ==False: group_dict['sorted'] =False
         
         index =0
         for tag in range(n_tags):
+            offset =self.pos
             tag_code,tag_name =self.name_header()
             if self.print: print('   ',tag,'Name:',tag_name,'      code:',tag_code)
             if root ==False and not tag_name:     #if tag_name=='', they are numbered
                 tag_name = str(index)
                 index +=1
+            tag_path =path +'/' +tag_name if path else tag_name
+            self.offsets[tag_path] =offset
             
-            if tag_code ==21:  # Tag
-                length_definitions,tag_length =self.tag_header()        
-                dtype = self.read_DMvalue() #common tag for all data types
-                if self.print: print('   tag_length',tag_length,'Length definition',length_definitions,'offset',self.f.tell(),'dtype',dtype)                
-                if length_definitions == 1:  # Simple type                 
-                    data = self.read_data(dtype)
-                
-                elif length_definitions == 2:  # String
-                    if dtype != 18:
-                        raise IOError("according length definition (2) it should be type 18, not",dtype)
-                    string_length =self.read_DMvalue() #extra tag for strings
-                    data = self.read_string(string_length)
-                    
-                elif length_definitions == 3:  # Array 
-                    if dtype != 20:  # Should be 20 for array
-                        raise IOError("according length definition (3) it should be type 20, not",dtype)
-                    eltype = self.read_DMvalue() #extra tags for arrays
-                    size = self.read_DMvalue()    
-                    if self.print: print('                 eltypes',eltype,'size',size)
-                    if group_name == "ImageData" and tag_name == "Data":# this is image array
-                        offset =self.f.tell()
-                        if self.print: print('ImageDataArray',dtype,' ',eltype," size ",size)
-                        pixel_depth =self.type_dict_DM[eltype][0]
-                        
-                        size_bytes =pixel_depth*size
-                        self.f.seek(size_bytes, 1)  # skip array
-                        data =(offset, size, eltype) # store its offset,size and type instead
-                        
-                    else:                                               #this is some other array
-                        data = self.read_array(size, eltype)
-                    
-                elif length_definitions > 3: #composed data
-                    if dtype == 15:  #  structure
-                        types = self.struct_types()   #types of all elements in structure
-                        if self.print: print('TupleType',types)
-                        data = self.read_structure(types)
-                    elif dtype == 20:  # array of something
-                        eltype = self.read_DMvalue()#type of array
-                        if eltype == 15:  # array of structures
-                            types = self.struct_types()#types of all elements in structure
-                            size = self.read_DMvalue()
-                            data = self.read_array(size,eltype,
-                                inserted={"types": types})
-                        elif eltype == 18:  # array of strings
-                            string_length =self.read_DMvalue() 
-                            size = self.read_DMvalue()
-                            data = self.read_array(size,eltype,
-                                inserted={"length": string_length})
-                        elif eltype == 20:  # array of arrays
-                            each_type =self.read_DMvalue()
-                            each_size =self.read_DMvalue() 
-                            size = self.read_DMvalue()
-                            data = self.read_array(size,each_type,#each_type=eltype ??
-                                inserted={"size": each_size})
-                    else: raise IOError('length definition',length_definitions,'or dtype',dtype,'are incorrect')  
-                    
-                else: raise IOError('Length definition must be non-zero !!')   
-                
-                group_dict[tag_name] = data
+            self.parse_entry(tag_code,tag_name,group_name,group_dict,tag_path)
+            
+            if group_name == "ImageList": 
+                self.n_images =index    #total number of images stored
                 
-            elif tag_code ==20:  # TagGroup
+        if self.print: print('End of Group',self.pos)
+
+
+    def parse_entry(self,tag_code:int,tag_name:str,group_name:str,group_dict:dict,tag_path:str):
+        """
+        Tag or TagGroup following its name header
+        in dm4, the entries named in self.skip are jumped over thanks to their length
+        """
+        skip =self.dm_ext ==4 and tag_name in self.skip
+        if tag_code ==21:  # Tag
+            if skip:
+                tag_length =self.unpack(header_int64)
+                self.pos +=tag_length
+            else:
+                group_dict[tag_name] =self.read_tag(group_name,tag_name)
+            
+        elif tag_code ==20:  # TagGroup
+            if skip:
+                l_group =self.unpack(header_uint64)
+                self.pos +=l_group
+            else:
                 group_dict[tag_name] ={}
                 self.parse_tags_to_dict(
                     group_name=tag_name,
-                    group_dict=group_dict[tag_name])
-                
-            else: raise IOError(tag,'ERROR',tag_code)
+                    group_dict=group_dict[tag_name],
+                    path=tag_path)
             
-            if group_name == "ImageList": 
-                self.n_images =index    #total number of images stored
+        else: raise IOError(tag_name,'ERROR',tag_code)
+
+
+    def read_tag(self,group_name:str,tag_name:str):
+        """
+        value of a Tag, after its name header
+        """
+        length_definitions,tag_length =self.tag_header()        
+        dtype = self.read_DMvalue() #common tag for all data types
+        if self.print: print('   tag_length',tag_length,'Length definition',length_definitions,'offset',self.pos,'dtype',dtype)                
+        if length_definitions == 1:  # Simple type                 
+            data = self.read_data(dtype)
+        
+        elif length_definitions == 2:  # String
+            if dtype != 18:
+                raise IOError("according length definition (2) it should be type 18, not",dtype)
+            string_length =self.read_DMvalue() #extra tag for strings
+            data = self.read_string(string_length)
+            
+        elif length_definitions == 3:  # Array 
+            if dtype != 20:  # Should be 20 for array
+                raise IOError("according length definition (3) it should be type 20, not",dtype)
+            eltype = self.read_DMvalue() #extra tags for arrays
+            size = self.read_DMvalue()    
+            if self.print: print('                 eltypes',eltype,'size',size)
+            if group_name == "ImageData" and tag_name == "Data":# this is image array
+                offset =self.pos
+                if self.print: print('ImageDataArray',dtype,' ',eltype," size ",size)
+                pixel_depth =self.type_dict_DM[eltype][0]
+                
+                size_bytes =pixel_depth*size
+                self.pos +=size_bytes  # skip array
+                data =(offset, size, eltype) # store its offset,size and type instead
                 
-        if self.print: print('End of Group',self.f.tell())
+            else:                                               #this is some other array
+                data = self.read_array(size, eltype)
+            
+        elif length_definitions > 3: #composed data
+            if dtype == 15:  #  structure
+                types = self.struct_types()   #types of all elements in structure
+                if self.print: print('TupleType',types)
+                data = self.read_structure(types)
+            elif dtype == 20:  # array of something
+                eltype = self.read_DMvalue()#type of array
+                if eltype == 15:  # array of structures
+                    types = self.struct_types()#types of all elements in structure
+                    size = self.read_DMvalue()
+                    data = self.read_array(size,eltype,
+                        inserted={"types": types})
+                elif eltype == 18:  # array of strings
+                    string_length =self.read_DMvalue() 
+                    size = self.read_DMvalue()
+                    data = self.read_array(size,eltype,
+                        inserted={"length": string_length})
+                elif eltype == 20:  # array of arrays
+                    each_type =self.read_DMvalue()
+                    each_size =self.read_DMvalue() 
+                    size = self.read_DMvalue()
+                    data = self.read_array(size,each_type,#each_type=eltype ??
+                        inserted={"size": each_size})
+            else: raise IOError('length definition',length_definitions,'or dtype',dtype,'are incorrect')  
+            
+        else: raise IOError('Length definition must be non-zero !!')
+
+        return data
+
+
+    def lookup(self,path:str):
+        """
+        value of the Tag or TagGroup at path (names joined by '/'), parsing only the smallest
+        known subtree that contains it. The subtree offsets join the index for the next lookups.
+        """
+        names =path.split('/')
+        for k in range(len(names), 0, -1):
+            known ='/'.join(names[:k])
+            if known in self.offsets: break
+        else: raise KeyError(path)
+        
+        skip =self.skip
+        self.skip =() #the requested subtree is parsed whole
+        try:
+            self.pos =self.offsets[known]
+            tag_code,tag_name =self.name_header()
+            tag_name =names[k-1] #numbered tags have no name in the file
+            entry ={}
+            self.parse_entry(tag_code,tag_name,names[k-2] if k>1 else '',entry,known)
+        finally:
+            self.skip =skip
+            
+        value =entry[tag_name]
+        for name in names[k:]:
+            value =value[name]
+        return strip_sorted(value)
         
 
     def make_image_list(self):
@@ -503,9 +685,13 @@ class read_DM(object):
         """
         offset,size, eltype =self.image_list[index]['ImageData']['Data']
         
-        dtype =self.type_dict_DM[eltype][2]
-        self.f.seek(offset)
-        image =np.fromfile(self.f,dtype =dtype,count =size)
+        dtype =np.dtype(self.type_dict_DM[eltype][2])
+        if self.mmap:
+            #copy-on-write: the array can be modified, the file is not
+            image =np.memmap(self.f,dtype =dtype,mode ='c',offset =offset,shape =(size,))
+        else:
+            image =np.frombuffer(self.buf.obj,dtype =dtype,count =size,offset =offset) #view on the file buffer, no copy
+            if offset % dtype.alignment != 0: image =image.copy() #aligned for numpy/OpenCV
         
         """
         read information
@@ -535,8 +721,9 @@ class read_DM(object):
         """
         elemental data piece
         """
-        data =self.type_dict_DM[dtype][3](self.f, self.endian)
-        data =self.type_dict_DM[dtype][5](data) #force numpy, not Python data type
+        data =self.unpack(self.struct_DM[dtype])
+        if self.type_dict_DM[dtype][5] is not None:
+            data =self.type_dict_DM[dtype][5](data) #force numpy, not Python data type
         
         return data
 
@@ -546,9 +733,8 @@ class read_DM(object):
         1byte char (DM code 9) seems to be used for tag names only
         for the strings, array of 2byte symbols (DM code 4) mostly used
         """
-        data = b''
-        for char in range(length):
-            data +=get_char(self.f,self.endian)
+        data =bytes(self.buf[self.pos:self.pos+length])
+        self.pos +=length
             
         try:
             data =data.decode('utf8')
@@ -580,7 +766,7 @@ class read_DM(object):
         """
         field_value = []
         for dtype in types:
-            data =self.type_dict_DM[dtype][3](self.f, self.endian)
+            data =self.unpack(self.struct_DM[dtype])
             data =self.type_dict_DM[dtype][5](data) #force numpy, not Python data type
             field_value.append(data)
 
@@ -598,20 +784,22 @@ class read_DM(object):
             data = [reader(**inserted)
                         for element in range(size)]
         else:  # array of numbers
-            if eltype ==4: #array of char, i.e. string (often in DM files)
-                data = ""
-                for i in range(size):
-                    data +=chr(reader(self.f, self.endian))
+            length =self.type_dict_DM[eltype][0]*size
+            if eltype ==4: #array of char, i.e. string (often in DM files), UTF-16 code units
+                encoding ='utf-16-le' if self.endian =='little' else 'utf-16-be'
+                data =bytes(self.buf[self.pos:self.pos+length]).decode(encoding, errors='surrogatepass')
             else:
-                data = [reader(self.f, self.endian) for element in range(size)]
-                data =self.type_dict_DM[eltype][5](data) #force numpy, not Python data type
+                dtype =np.dtype(self.type_dict_DM[eltype][1]).newbyteorder(set_endian(self.endian))
+                data =np.frombuffer(self.buf,dtype =dtype,count =size,offset =self.pos)
+                data =data.astype(self.type_dict_DM[eltype][1]) #force numpy, native byte order, own copy
+            self.pos +=length
                 
         return data
 
     def get_matadata(self, index) ->dict:
         meta_dict =None
         if 'ImageTags'in self.image_list[index]:
-            meta_dict =self.image_list[index]['ImageTags']
+            meta_dict =strip_sorted(self.image_list[index]['ImageTags'])
 
         return meta_dict
 
@@ -660,14 +848,41 @@ class write_DM(object):
         return Ttype
     
     
-    def set_DMvalue(self,value:int) ->int:
+    def set_DMvalue(self,value:int) ->bytes:
         """
         diferent int length for dm3 and dm4
         """
         if self.dm_ext ==4:
-            return set_int64(value, "big")
+            return header_int64.pack(value)
         else:
-            return set_int32(value, "big")
+            return header_int32.pack(value)
+
+
+    def set_DMvalues(self,*values) ->bytes:
+        """
+        several DM values in one pack
+        """
+        if self.dm_ext ==4:
+            return struct.pack('>%dq' % len(values),*values)
+        else:
+            return struct.pack('>%dl' % len(values),*values)
+
+
+    def set_array(self,item,eltype:str) ->bytes:
+        """
+        numbers of an array in one block, with the byte ordering of the file
+        """
+        dtype =np.dtype(self.type_dict_NP[eltype][5]).newbyteorder(set_endian(self.endian))
+        return np.asarray(item,dtype =dtype).tobytes()
+
+
+    def set_symbols(self,item:str) ->tuple:
+        """
+        string as an array of 2byte symbols (UTF-16 code units), returns (number of symbols, bytes)
+        """
+        encoding ='utf-16-le' if self.endian =='little' else 'utf-16-be'
+        data =item.encode(encoding, errors='surrogatepass')
+        return len(data)//2, data
  
                    
     def must_tags(self,dim:int,dimensions:dict,calibration =None,metadata =None) ->dict:
@@ -753,40 +968,36 @@ class write_DM(object):
      
     def file_header(self,f_size:int) ->bytes:
         #prepare the file header
-        b_header =b''
-        b_header +=set_int32(self.dm_ext,'big') #3(dm3) or 4(dm4)
-        
-        b_header +=self.set_DMvalue(f_size)#size of the file
-        
         if self.endian =='little':
             end =1
         else: end =0     
-        b_header +=set_int32(end,'big') #set endian
-        
-        return b_header
+        return b''.join([header_int32.pack(self.dm_ext), #3(dm3) or 4(dm4)
+                         self.set_DMvalue(f_size), #size of the file
+                         header_int32.pack(end)]) #set endian
     
         
     def group_header(self,is_sorted:int,n_tags:int,root:bool):       
         if self.dm_ext ==4 and root is False:
-            self.b +=set_uint64(0,'big') #grouplength is set to Zero initially
+            self.b +=header_uint64.pack(0) #grouplength is set to Zero initially
             self.group_stack.append(len(self.b)) #store offset
 
-        self.b +=set_uint8(is_sorted,'big') #is group sorted
-        self.b +=set_uint8(0,'big') #group is not open
+        self.b +=header_uint8.pack(is_sorted) #is group sorted
+        self.b +=header_uint8.pack(0) #group is not open
             
         self.b +=self.set_DMvalue(n_tags) #number of tags in group
     
         
     def name_header(self,Ttype,Label):
         if Ttype =='dict': 
-            self.b +=set_uint8(20,'big') #that is a tag group not single tag
+            self.b +=header_uint8.pack(20) #that is a tag group not single tag
         else: 
-            self.b +=set_uint8(21,'big') #that is a tag
+            self.b +=header_uint8.pack(21) #that is a tag
         
         if Label in tag_counts(): Label =''
             
-        self.b +=set_uint16(len(Label),'big') #Label length
-        self.b +=self.set_string(Label) #Label of tag or tagGroup
+        Label =self.set_string(Label)
+        self.b +=header_uint16.pack(len(Label)) #Label length
+        self.b +=Label #Label of tag or tagGroup
 
 
     def set_string(self, TxtLabel:str)->bytes:
@@ -798,26 +1009,24 @@ class write_DM(object):
     
     def tag_header(self,Ttype,item):
         if self.dm_ext ==4: 
-            self.b +=set_uint64(0,'big') #tag length (set to zero for the moment)
+            self.b +=header_uint64.pack(0) #tag length (set to zero for the moment)
             self.tag_address =len(self.b) #memorize the address for this note
-        self.b +=self.set_string('%%%%') #marker for starting tag  
+        self.b +=b'%%%%' #marker for starting tag  
 
           
     def image_tag_header(self): #includes also the image name header
-        self.b +=set_uint8(21,'big') #that is a tag, not tag group
-        self.b +=set_uint16(4,'big') #Label length
-        self.b +=self.set_string('Data') #replace the signal code for the standard image data label
+        self.b +=header_uint8.pack(21) #that is a tag, not tag group
+        self.b +=header_uint16.pack(4) #Label length
+        self.b +=b'Data' #replace the signal code for the standard image data label
 
         if self.dm_ext ==4:  
             length =self.size*self.depth +16 +8 +8 +4
-            self.b +=set_uint64(length,'big') #length of the image array
+            self.b +=header_uint64.pack(length) #length of the image array
 
-        self.b +=self.set_string('%%%%') #marker for starting tag 
+        self.b +=b'%%%%' #marker for starting tag 
         
-        self.b +=self.set_DMvalue(3) # 3 positions needed to describe an array
-        self.b +=self.set_DMvalue(20) #20: DM code of array (1st position) 
-        self.b +=self.set_DMvalue(self.type) #type of array elements (2nd position)
-        self.b +=self.set_DMvalue(self.size) #size of array (3th position)        
+        # 3 positions needed to describe an array: 20 DM code of array, type of array elements, size of array
+        self.b +=self.set_DMvalues(3,20,self.type,self.size)
         if self.print: print('Image Data headed')
 
 
@@ -827,16 +1036,14 @@ class write_DM(object):
         """
         offset =self.tag_address #retrive the last stored address of the tag length
         tag_length =len(self.b)-offset
-        tag_length_b =set_int64(tag_length,'big')
-        self.b[offset-8:offset] =tag_length_b
+        header_int64.pack_into(self.b,offset-8,tag_length)
   
         
     def tag(self,Ttype:str,item):        
         self.tag_header(Ttype,item) #write tag header
            
         if Ttype in NP_number_types(): #a number
-            self.b +=self.set_DMvalue(1) # 1 position needed to describe a number type
-            self.b +=self.set_DMvalue(self.type_dict_NP[Ttype][2]) #DM code
+            self.b +=self.set_DMvalues(1,self.type_dict_NP[Ttype][2]) # 1 position needed to describe a number type, DM code
             self.b +=self.type_dict_NP[Ttype][4](item,self.endian) #number self
             
         elif Ttype =='str': #a string
@@ -848,30 +1055,21 @@ class write_DM(object):
             self.b +=self.set_string(item) #string self
             """
             
-            self.b +=self.set_DMvalue(3) # 3 positions needed to describe an array
-            self.b +=self.set_DMvalue(20) #20 -DM code of array (1st position) 
-            self.b +=self.set_DMvalue(4) #type of array elements uint8 (2nd position)
-            size =len(item)
-            self.b +=self.set_DMvalue(size) #size of array (3th position)
-            for i in range(size):
-                self.b +=set_uint16(ord(item[i]),self.endian) 
+            size,symbols =self.set_symbols(item)
+            # 3 positions needed to describe an array: 20 DM code of array, type of array elements uint16, size of array
+            self.b +=self.set_DMvalues(3,20,4,size)
+            self.b +=symbols
                 
         elif Ttype =='list' or Ttype =='ndarray': #an array
-            self.b +=self.set_DMvalue(3) # 3 positions needed to describe an array
-            self.b +=self.set_DMvalue(20) #20 -DM code of array (1st position) 
             eltype =self.get_type(item[0]) #take type of the first array element
             elcode =self.type_dict_NP[eltype][2] #DM code
-            self.b +=self.set_DMvalue(elcode) #type of array elements (2nd position)
-            size =len(item)
-            self.b +=self.set_DMvalue(size) #size of array (3th position)
-            if elcode ==4:
-                for i in range(size):
-                    #print(item[i])
-                    self.b +=self.type_dict_NP[eltype][4](ord(item[i]),self.endian) 
+            if elcode ==4 and isinstance(item[0],str): #array of characters
+                size,data =self.set_symbols(''.join(item))
             else:    
-                for i in range(size):
-                    #print(item[i])
-                    self.b +=self.type_dict_NP[eltype][4](item[i],self.endian) #array self
+                size,data =len(item),self.set_array(item,eltype) #array self
+            # 3 positions needed to describe an array: 20 DM code of array, type of array elements, size of array
+            self.b +=self.set_DMvalues(3,20,elcode,size)
+            self.b +=data
                 
         elif Ttype =='tuple': #a tuple
             size =len(item)
@@ -904,13 +1102,11 @@ class write_DM(object):
         else:                 
             if is_broken ==True:
                 group_length =len(self.b_before) -offset +self.size*self.depth +len(self.b) 
-                group_length_b =set_int64(group_length,'big')
                 #as offset was accounted in b_before
-                self.b_before[offset-8:offset] =group_length_b
+                header_int64.pack_into(self.b_before,offset-8,group_length)
             else:  
                 group_length =len(self.b) -offset
-                group_length_b =set_int64(group_length,'big')
-                self.b[offset-8:offset] =group_length_b
+                header_int64.pack_into(self.b,offset-8,group_length)
                 
             if self.print:  print('end of group','offset',offset,'groupLength',group_length)
 
@@ -956,3 +1152,83 @@ class write_DM(object):
         if self.dm_ext ==4: self.group_end(is_broken)  #write the tag group length  
         
 
+"""
+CLASS store 3D stack
+""" 
+class dm_stack(object):
+    """
+    tilt series as one (n_frames, height, width) dm file, frames are appended in place
+    disk space is reserved by chunks of frames, the header, the dimensions/length tags
+    and the tilt angles (ImageTags 'Tilt angles' array) are patched at flush and close
+    one writer thread expected, e.g. frame_writer(lambda image, angle: stack.append(image, angle), workers=1)
+    """
+    def __init__(self,filename,shape:tuple,im_type,dm_ext ='dm4',chunk =32,calibration =None,meta =None):
+        self.filename =filename
+        self.height,self.width =shape
+        self.im_type =str(np.dtype(im_type)) #NumPy type of the frames
+        self.dm_ext =dm_ext
+        self.chunk =chunk #number of frames reserved at once
+        self.calibration =calibration
+        self.meta =meta
+        self.angles =[]
+        self.n =0 #number of frames written
+        self.capacity =0 #number of frames reserved on disk
+        self.frame_bytes =self.height*self.width*np.dtype(self.im_type).itemsize
+        
+        dm =self.buffers(0)
+        self.offset =len(dm.b_header)+len(dm.b_before) #start of the image data, fixed size fields before it
+        self.f =open(filename,'w+b')
+        
+        
+    def buffers(self,n:int) ->write_DM:
+        """
+        tags of a stack of n frames
+        """
+        meta =dict(self.meta) if self.meta !=None else {}
+        if n >0: meta['Tilt angles'] =np.asarray(self.angles[:n],dtype =np.float32)
+        dimensions ={'0':self.width,'1':self.height,'2':n}
+        
+        dm =write_DM(self.im_type,n*self.height*self.width,self.dm_ext,False)
+        dm.must_tags(3,dimensions,self.calibration,meta if meta else None)
+        dm.write_to_buffer()
+        return dm
+    
+    
+    def append(self,image,angle:float =0.):
+        image =np.asarray(image)
+        if image.shape !=(self.height,self.width):
+            raise ValueError('frame shape ' +str(image.shape) +' differs from the stack ' +str((self.height,self.width)))
+        if self.n ==self.capacity: #reserve the next chunk of frames
+            self.capacity +=self.chunk
+            self.f.truncate(self.offset +self.capacity*self.frame_bytes)
+            
+        self.f.seek(self.offset +self.n*self.frame_bytes)
+        self.f.write(image_buffer(image.astype(self.im_type,copy =False)))
+        self.angles.append(angle)
+        self.n +=1
+        
+        
+    def flush(self):
+        """
+        make the file a valid dm file with the frames written so far
+        the tags after the image are overwritten by the next frame, the reserved space is kept
+        (zeros after the end marker until close)
+        """
+        dm =self.buffers(self.n)
+        if len(dm.b_header)+len(dm.b_before) !=self.offset:
+            raise ValueError('stack header size changed')
+        self.f.seek(0)
+        self.f.write(dm.b_header) #file size
+        self.f.write(dm.b_before) #group and image lengths
+        self.f.seek(self.offset +self.n*self.frame_bytes)
+        self.f.write(dm.b_after) #dimensions, angles
+        self.f.write(set_uint64(0,'little')) #end marker
+        self.f.flush()
+        
+        
+    def close(self):
+        if self.f.closed: return
+        self.flush()
+        self.f.truncate() #release the reserved frames, the file ends at the end marker
+        self.f.close()
+
@@ -3,10 +3,12 @@ import sys
 import numpy as np
 import cv2 as cv
 from scipy import interpolate
+import scipy.fft as sfft
 from scipy.signal import find_peaks
 from scipy.optimize import curve_fit
 import os
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 # plt.switch_backend('agg')  # Switching backend if necessary
 import logging
 import time
@@ -15,7 +17,13 @@ from copy import deepcopy
 from tifffile import imread
 from PIL import Image, ImageTk
 import faiss
-from threading import Lock, Condition
+from threading import Lock, Condition, Thread
+import queue
+from collections import OrderedDict, deque
+from functools import partial
+from types import SimpleNamespace
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
 import math
 
 from com_functions2 import microscope
@@ -53,6 +61,99 @@ def s_print(*a, **b):
     print(*a, **b)
     s_print_lock.release()
 
+class diagnostics_writer(object):
+    ''' Render and save diagnostic images (matches, fits) in a worker thread, off the acquisition path.
+
+    Input:
+        - mode: 'every' saves one sample out of every and all failures, 'failure' only failures, 'off' nothing (str).
+        - every: sampling period in number of submitted samples (int).
+        - maxsize: number of pending samples, the oldest is dropped when the queue is full (int).
+
+    Exemple:
+        diagnostics.configure(mode='every', every=10)
+        diagnostics.submit(render, 'data/tmp/match.png', failed=False)
+            -> render() returns an image (ndarray) or a matplotlib Figure, saved to data/tmp/match.png
+    '''
+    modes = ('every', 'failure', 'off')
+
+    def __init__(self, mode='every', every=1, maxsize=8):
+        self.queue   = queue.Queue(maxsize=maxsize)
+        self.lock    = Lock()
+        self.thread  = None
+        self.count   = 0
+        self.stats   = {'submitted': 0, 'written': 0, 'dropped': 0, 'errors': 0}
+        self.configure(mode, every)
+
+    def configure(self, mode=None, every=None):
+        if mode != None:
+            if mode not in self.modes:
+                raise ValueError('Unknown diagnostics mode ' + str(mode) + ', expected one of ' + str(self.modes))
+            self.mode = mode
+        if every != None:
+            self.every = max(1, int(every))
+
+    def sampled(self, failed=False) -> bool:
+        ''' Sampling decision, to be asked before preparing anything costly for submit.
+        '''
+        if self.mode == 'off':
+            return False
+        if failed:
+            return True
+        if self.mode == 'failure':
+            return False
+        with self.lock:
+            self.count += 1
+            return (self.count - 1) % self.every == 0
+
+    def submit(self, render, path, failed=False, sampled=None) -> bool:
+        ''' Queue render() to be saved at path, return True if queued.
+        '''
+        if sampled == None:
+            sampled = self.sampled(failed)
+        if not sampled:
+            return False
+        with self.lock:
+            self.stats['submitted'] += 1
+            while True:
+                try:
+                    self.queue.put_nowait((render, path))
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.queue.task_done()
+                        self.stats['dropped'] += 1
+                    except queue.Empty:
+                        pass
+            if self.thread == None or not self.thread.is_alive():
+                self.thread = Thread(target=self.run, name='diagnostics', daemon=True)
+                self.thread.start()
+        return True
+
+    def run(self):
+        while True:
+            render, path = self.queue.get()
+            try:
+                result = render()
+                if isinstance(result, Figure):
+                    result.savefig(path)
+                else:
+                    cv.imwrite(path, result)
+                self.stats['written'] += 1
+            except Exception as ex:
+                self.stats['errors'] += 1
+                logging.info('Diagnostics not saved ' + str(path) + ': ' + str(ex))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        ''' Wait for the pending diagnostics to be written.
+        '''
+        if self.thread != None and self.thread.is_alive():
+            self.queue.join()
+
+diagnostics = diagnostics_writer()
+
 def automatic_brightness_and_contrast(image, clip_hist_percent=1):
     '''
     Perform automatic brightness and contrast optimization on the input image.
@@ -180,6 +281,16 @@ def function_displacement(x, z, y, R):
     return y * (1 - np.cos(x)) + z * np.sin(x) + R * (1 - np.sin(x))  # np.multiply(x, x2))) + x3
 
 
+def plot_eucentric(angle, displacement, alpha, displacement_interp, displacement_fit) -> Figure:
+    ''' Measured (green), interpolated (blue) and fitted (red) displacement against tilt angle.
+    '''
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.plot(angle, displacement, 'green')
+    ax.plot(alpha, displacement_interp, 'blue')
+    ax.plot(alpha, displacement_fit, 'red')
+    return fig
+
 def correct_eucentric(microscope, positioner, displacement, angle):
     ''' Calculate z and y parameters for postioner eucentric correction, correct it, correct microscope view and focus.
 
@@ -229,11 +340,8 @@ def correct_eucentric(microscope, positioner, displacement, angle):
 
     logging.info('z0 =' + number_format(z0_calc) + '+-' + number_format(stdevs[0]) + 'y0 = ' + number_format(-direction*y0_calc) + '+-' + number_format(stdevs[1]))# + 'R = ' + number_format(R_calc) + '+-' + number_format(stdevs[2]) + 'x2 = ' + number_format(x2_calc) + '+-' + number_format(stdevs[3]) + 'x3 = ' + number_format(x3_calc) + '+-' + number_format(stdevs[4]))
     
-    plt.plot([i/pas for i in angle_sort], [i[1]-offset for i in displacement], 'green')
-    plt.plot(alpha, displacement_y_interpa, 'blue')
-    plt.plot(alpha, function_displacement(alpha, *res), 'red')
-    plt.savefig('data/tmp/' + str(time.time()) + 'correct_eucentric.png')
-    plt.show()
+    diagnostics.submit(partial(plot_eucentric, [i/pas for i in angle_sort], [i[1]-offset for i in displacement], alpha, displacement_y_interpa, function_displacement(alpha, *res)),
+                       'data/tmp/' + str(time.time()) + 'correct_eucentric.png')
 
     if microscope.microscope_type == 'ESEM':
         positioner.relative_move(0, y0_calc, z0_calc, 0, 0, hold=True)
@@ -241,18 +349,11 @@ def correct_eucentric(microscope, positioner, displacement, angle):
         microscope.focus(z0_calc, 'rel') 
     elif microscope.microscope_type == 'ETEM':
         positioner.relative_move(0, -y0_calc, z0_calc, 0, 0, hold=True)
-        plt.plot(alpha, displacement_y_interpa, 'blue')
-        plt.show()
         microscope.beam_shift(0, y0_calc, 'rel')
-        plt.plot(alpha, displacement_y_interpa, 'blue')
-        plt.show()
         microscope.image_shift(0, y0_calc, 'rel')
         microscope.focus(z0_calc, 'rel')
-        plt.plot(alpha, displacement_y_interpa, 'blue')
-        plt.show()
-    plt.clf()
 
-def match(image_master, image_template, grid_size = 3, ratio_template_master = 0.9, ratio_master_template_patch = 0, speed_factor = 0, resize_factor = 1):
+def match(image_master, image_template, grid_size = 3, ratio_template_master = 0.9, ratio_master_template_patch = 0, speed_factor = 0, resize_factor = 1, coarse_factor = None):
     ''' Match two images
 
     Input:
@@ -262,6 +363,7 @@ def match(image_master, image_template, grid_size = 3, ratio_template_master = 0
         - ratio_template_master: Ratio of image_template used for computation. Between 0 and 1 (float).
         - ratio_master_template_patch: Ratio for master patch size from template patch. Is computed optimaly by default (float).
         - speed_factor: reduce master patch size for speed optimization. Decrease precision and is not recommended for high displacements (int).
+        - coarse_factor: decimation of the exhaustive search before full resolution refinement. Deduced from the blur by default (int).
 
     Output:
         - Displacement vector in pixels (list[float, float]).
@@ -286,69 +388,33 @@ def match(image_master, image_template, grid_size = 3, ratio_template_master = 0
     template_patch_size = (height_template//grid_size,
                             width_template//grid_size)
 
-    displacement_vector = np.array([[0,0]])
-    corr_trust = np.array(0)
-
-    t_temp = 0
-    t_match = 0
-    t_calc = 0
-    t_append = 0
-    for i in range(grid_size):
-        for j in range(grid_size):
-            t1 = time.time()
-            template_patch_xA      = (height_master - height_template)//2 + (i)*template_patch_size[0]
-            template_patch_yA      = (width_master  - width_template)//2  + (j)*template_patch_size[1]
-            template_patch_xB      = (height_master - height_template)//2 + (i+1)*template_patch_size[0]
-            template_patch_yB      = (width_master  - width_template)//2  + (j+1)*template_patch_size[1]
-
-            template_patch         = image_template[int(template_patch_xA):int(template_patch_xB),
-                                                    int(template_patch_yA):int(template_patch_yB)]
-
-            t2 = time.time()
-            t_temp += t2 - t1
-            corr_scores            = cv.matchTemplate(image_master, template_patch, cv.TM_CCOEFF) #TM_CCOEFF_NORMED
-            t3 = time.time()
-            t_match += t3 - t2
-            _, max_val, _, max_loc = cv.minMaxLoc(corr_scores)
-            
-            dx                     = (template_patch_xA - max_loc[1])*resize_factor
-            dy                     = (template_patch_yA - max_loc[0])*resize_factor
-            t4 = time.time()
-            t_calc += t4 - t3
-            displacement_vector    = np.append(displacement_vector, [[dx, dy]], axis=0)
-            corr_trust             = np.append(corr_trust, max_val)
-            t5 = time.time()
-            t_append += t5 - t4
-
-    # t_temp = t_temp/(grid_size**2)
-    # t_match = t_match/(grid_size**2)
-    # t_calc = t_calc/(grid_size**2)
-    # t_append = t_append/(grid_size**2)
-    #logging.info('t_temp' +  t_temp +  't_match' +  t_match +  't_calc' +  t_calc +  't_append' +  t_append)
-
-    corr_trust_x          = np.delete(corr_trust, 0)
-    corr_trust_y          = deepcopy(corr_trust_x)
-    displacement_vector = np.delete(displacement_vector,0,0)
-    dx_tot              = displacement_vector[:,0]
-    dy_tot              = displacement_vector[:,1]
-
-    # plt.plot(dx_tot, '--r')
-    # plt.plot(dy_tot, '--g')
+    # Top-left corner of every grid cell, row-major like the former i, j loop
+    template_patch_xA = (height_master - height_template)//2 + np.arange(grid_size)*template_patch_size[0]
+    template_patch_yA = (width_master  - width_template)//2  + np.arange(grid_size)*template_patch_size[1]
+    template_patch_xA, template_patch_yA = [a.ravel() for a in np.meshgrid(template_patch_xA, template_patch_yA, indexing='ij')]
+
+    if coarse_factor == None:
+        blur_sigma    = 0.3*((n - 1)*0.5 - 1) + 0.8 # sigma used by cv.GaussianBlur for a (n,n) kernel
+        coarse_factor = max(1, round(blur_sigma*resize_factor/2)) # the blurred images carry nothing finer
+    max_loc_x, max_loc_y, corr_trust = match_grid_fft(image_master, image_template, template_patch_xA, template_patch_yA, template_patch_size, coarse_factor)
+
+    dx_tot = (template_patch_xA - max_loc_x)/resize_factor
+    dy_tot = (template_patch_yA - max_loc_y)/resize_factor
 
+    keep_x = np.ones(dx_tot.shape, dtype=bool)
+    keep_y = np.ones(dy_tot.shape, dtype=bool)
     for k in range(2): # Delete incoherent values
-        mean_x  = np.mean(dx_tot)
-        mean_y  = np.mean(dy_tot)
-        stdev_x = np.std(dx_tot)
-        stdev_y = np.std(dy_tot)
-
-        for d in dx_tot:
-            if (d < mean_x - stdev_x) or (mean_x + stdev_x < d):
-                corr_trust_x = np.delete(corr_trust_x, np.where(dx_tot==d))
-                dx_tot = np.delete(dx_tot, np.where(dx_tot==d))
-        for d in dy_tot:
-            if (d < mean_y - stdev_y) or (mean_y + stdev_y < d):
-                corr_trust_y = np.delete(corr_trust_y, np.where(dy_tot==d))
-                dy_tot = np.delete(dy_tot, np.where(dy_tot==d))
+        mean_x  = np.mean(dx_tot[keep_x])
+        mean_y  = np.mean(dy_tot[keep_y])
+        stdev_x = np.std(dx_tot[keep_x])
+        stdev_y = np.std(dy_tot[keep_y])
+        keep_x &= (mean_x - stdev_x <= dx_tot) & (dx_tot <= mean_x + stdev_x)
+        keep_y &= (mean_y - stdev_y <= dy_tot) & (dy_tot <= mean_y + stdev_y)
+
+    corr_trust_x = corr_trust[keep_x]
+    corr_trust_y = corr_trust[keep_y]
+    dx_tot       = np.float64(dx_tot[keep_x]).reshape(-1, 1)
+    dy_tot       = np.float64(dy_tot[keep_y]).reshape(-1, 1)
 
     try:
         dx_tot = cv.blur(dx_tot, (1, dx_tot.shape[0]//4))
@@ -356,115 +422,695 @@ def match(image_master, image_template, grid_size = 3, ratio_template_master = 0
     except:
         pass
 
-    # plt.plot(dx_tot, 'red')
-    # plt.plot(dy_tot, 'green')
-    # plt.show()
-
     a = np.average(dx_tot.reshape((len(dx_tot),)), weights=corr_trust_x)
     b = np.average(dy_tot.reshape((len(dy_tot),)), weights=corr_trust_y)
     c = np.mean(np.array([np.mean(corr_trust_x), np.mean(corr_trust_y)]))
     return a, b, c
 
-def cv2_copy(keypoints):
-    keypoints_copy = []
-    for i in range(len(keypoints)):
-        temp = {'pt': keypoints[i].pt,
-                'size': keypoints[i].size,
-                'angle': keypoints[i].angle,
-                'octave': keypoints[i].octave,
-                'response':keypoints[i].response,
-                'class_id': keypoints[i].class_id}
-        
-        point = cv.KeyPoint(x=temp['pt'][0],
-                            y=temp['pt'][1],
-                            size=temp['size'],
-                            angle=temp['angle'],
-                            octave=temp['octave'],
-                            response=temp['response'],
-                            class_id=temp['class_id'])
-        keypoints_copy.append(point)
+def match_grid_fft(image_master, image_template, patch_xA, patch_yA, patch_size, coarse_factor=1, max_batch_bytes=256*2**20, candidates=1, coarse_candidates=16):
+    ''' Cross-correlate all template patches against the whole master in the Fourier domain.
 
-    return keypoints_copy
+    The master spectrum is computed once and the zero-mean patches (same score as cv.TM_CCOEFF)
+    are correlated by batches, so memory stays below max_batch_bytes whatever the grid size.
+    With coarse_factor > 1, the search is done on images decimated by coarse_factor. Small patches
+    of blurred images have several peaks of close height, and decimation can swap their order:
+    the coarse_candidates highest local maxima of each patch are refined at full resolution in a
+    +-coarse_factor pixels window, and the best full resolution score is kept.
 
-def match_by_features_SIFT_create(microscope, img, mid_strips=0, resize_factor=1):
+    Input:
+        - image_master: blurred master image (ndarray).
+        - image_template: blurred template image (ndarray).
+        - patch_xA, patch_yA: top-left corner (row, column) of each patch in image_template (ndarray[int]).
+        - patch_size: (height, width) of the patches in pixels (tuple[int, int]).
+        - coarse_factor: decimation of the exhaustive search, 1 for a full resolution search (int).
+        - max_batch_bytes: upper bound of the spectra allocated per batch (int).
+        - candidates: number of local maxima returned per patch, best first (int).
+        - coarse_candidates: number of coarse local maxima refined per patch (int).
+
+    Output:
+        - Row of the best match of each patch in image_master (ndarray[int], (n_patches, candidates) if candidates > 1).
+        - Column of the best match of each patch in image_master (ndarray[int], idem).
+        - Maximum correlation score of each patch (ndarray[float], idem).
+
+    Exemple:
+        max_loc_x, max_loc_y, max_val = match_grid_fft(img1, img2, np.array([0]), np.array([0]), (64, 64))
+    '''
+    height_master, width_master = image_master.shape
+    height_patch, width_patch   = int(patch_size[0]), int(patch_size[1])
+    n_patches = len(patch_xA)
+    max_loc_x = np.empty((n_patches, candidates), dtype=np.int64)
+    max_loc_y = np.empty((n_patches, candidates), dtype=np.int64)
+    max_val   = np.empty((n_patches, candidates), dtype=np.float64)
+
+    if coarse_factor > 1 and candidates == 1 and min(height_patch, width_patch)//coarse_factor >= 4:
+        f = int(coarse_factor)
+        master_coarse   = cv.resize(np.float32(image_master),   (width_master//f, height_master//f), interpolation=cv.INTER_AREA)
+        template_coarse = cv.resize(np.float32(image_template), (image_template.shape[1]//f, image_template.shape[0]//f), interpolation=cv.INTER_AREA)
+        coarse_x, coarse_y, _ = match_grid_fft(master_coarse, template_coarse, np.asarray(patch_xA)//f, np.asarray(patch_yA)//f,
+                                               (height_patch//f, width_patch//f), 1, max_batch_bytes, candidates=coarse_candidates)
+        coarse_x, coarse_y = coarse_x.reshape(n_patches, -1), coarse_y.reshape(n_patches, -1)
+        image_master   = np.float32(image_master)
+        image_template = np.float32(image_template)
+        max_val[:] = -np.inf
+        for k in range(n_patches):
+            xA, yA = patch_xA[k], patch_yA[k]
+            patch = image_template[xA:xA+height_patch, yA:yA+width_patch]
+            for c in range(coarse_x.shape[1]):
+                x0 = min(max(0, coarse_x[k, c]*f - f), height_master - height_patch)
+                y0 = min(max(0, coarse_y[k, c]*f - f), width_master  - width_patch)
+                x1 = min(height_master, coarse_x[k, c]*f + f + height_patch + 1)
+                y1 = min(width_master,  coarse_y[k, c]*f + f + width_patch + 1)
+                corr_scores = cv.matchTemplate(image_master[x0:x1, y0:y1], patch, cv.TM_CCOEFF)
+                _, val, _, max_loc = cv.minMaxLoc(corr_scores)
+                if val > max_val[k, 0]:
+                    max_val[k, 0]   = val
+                    max_loc_x[k, 0] = x0 + max_loc[1]
+                    max_loc_y[k, 0] = y0 + max_loc[0]
+        return max_loc_x[:, 0], max_loc_y[:, 0], max_val[:, 0]
+
+    fft_height   = sfft.next_fast_len(height_master, real=True)
+    fft_width    = sfft.next_fast_len(width_master, real=True)
+    valid_height = height_master - height_patch + 1
+    valid_width  = width_master  - width_patch + 1
+
+    master_spectrum = sfft.rfft2(np.float32(image_master), s=(fft_height, fft_width), workers=-1)
+
+    batch   = max(1, min(n_patches, int(max_batch_bytes//(master_spectrum.nbytes*3))))
+    patches = np.empty((batch, height_patch, width_patch), dtype=np.float32)
+
+    for start in range(0, n_patches, batch):
+        stop = min(start + batch, n_patches)
+        n = stop - start
+        for k in range(n):
+            xA, yA = patch_xA[start+k], patch_yA[start+k]
+            patches[k] = image_template[xA:xA+height_patch, yA:yA+width_patch]
+        patches[:n] -= patches[:n].mean(axis=(1, 2), keepdims=True)
+
+        # Zero-padding the patches makes the circular correlation exact on the valid area.
+        # Rows are transformed before padding and only the valid rows are transformed back.
+        patches_spectrum = sfft.fft(sfft.rfft(patches[:n], n=fft_width, axis=2, workers=-1), n=fft_height, axis=1, workers=-1)
+        corr_scores = sfft.ifft(np.conj(patches_spectrum, out=patches_spectrum)*master_spectrum, axis=1, workers=-1)[:, :valid_height]
+        corr_scores = sfft.irfft(corr_scores, n=fft_width, axis=2, workers=-1)[:, :, :valid_width]
+        flat = corr_scores.reshape(n, -1)
+        if candidates == 1:
+            ind = np.argmax(flat, axis=1)[:, None]
+        else:
+            ind = np.empty((n, candidates), dtype=np.int64)
+            for k in range(n):
+                # Local maxima (3x3), highest first, the best one repeated if there are fewer
+                scores = np.ascontiguousarray(corr_scores[k])
+                peaks  = np.flatnonzero(scores == cv.dilate(scores, None))
+                peaks  = peaks[np.argsort(scores.ravel()[peaks])[::-1][:candidates]]
+                ind[k] = np.concatenate([peaks, np.repeat(peaks[:1], candidates - len(peaks))])
+        max_val[start:stop]   = np.take_along_axis(flat, ind, axis=1)
+        max_loc_x[start:stop] = ind // valid_width
+        max_loc_y[start:stop] = ind %  valid_width
+
+    if candidates == 1:
+        return max_loc_x[:, 0], max_loc_y[:, 0], max_val[:, 0]
+    return max_loc_x, max_loc_y, max_val
+
+def upsampled_dft(data, upsampled_region_size, upsample_factor, axis_offsets):
+    ''' Matrix-multiply DFT of a small region of the upsampled inverse transform of data.
+    From: scikit-image, skimage.registration._phase_cross_correlation (Guizar-Sicairos et al., 2008)
+    '''
+    for n_items, axis_offset in list(zip(data.shape, axis_offsets))[::-1]:
+        kernel = np.exp(-2j*np.pi*(np.arange(upsampled_region_size) - axis_offset)[:, None]*np.fft.fftfreq(n_items, upsample_factor))
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+def phase_correlation(image_master, image_template, upsample_factor=10):
+    ''' Sub-pixel translation between two images by windowed phase correlation.
+
+    Input:
+        - image_master: image before the displacement (ndarray).
+        - image_template: image after the displacement (ndarray). Both are cropped to their common top-left area.
+        - upsample_factor: the peak is refined to 1/upsample_factor pixel (int).
+
+    Output:
+        - Displacement (x, y) of the image content from image_template to image_master in pixels (float, float).
+        - Phase correlation peak between 0 and 1 (float).
+
+    Exemple:
+        shift_x, shift_y, peak = phase_correlation(img1, img2)
+            -> 20.3, -4.1, 0.31
+    '''
+    height = min(image_master.shape[0], image_template.shape[0])
+    width  = min(image_master.shape[1], image_template.shape[1])
+    window = cv.createHanningWindow((width, height), cv.CV_32F)
+
+    image_master   = np.float32(image_master[:height, :width])
+    image_template = np.float32(image_template[:height, :width])
+    spectrum_master   = sfft.fft2((image_master   - np.mean(image_master))*window, workers=-1)
+    spectrum_template = sfft.fft2((image_template - np.mean(image_template))*window, workers=-1)
+
+    # Whitened spectrum for a sharp integer peak, raw cross-power for the sub-pixel refinement
+    image_product     = spectrum_template*np.conj(spectrum_master)
+    cross_correlation = np.abs(sfft.ifft2(image_product/(np.abs(image_product) + np.finfo(np.float32).eps), workers=-1))
+
+    shifts = np.array(np.unravel_index(np.argmax(cross_correlation), cross_correlation.shape), dtype=np.float64)
+    peak   = cross_correlation.max()
+    shape  = np.array(cross_correlation.shape)
+    shifts[shifts > shape//2] -= shape[shifts > shape//2]
+
+    if upsample_factor > 1:
+        shifts = np.round(shifts*upsample_factor)/upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor*3)) # +-1.5 pixel around the whitened peak
+        dftshift = np.fix(upsampled_region_size/2.0)
+        cross_correlation = np.abs(upsampled_dft(np.conj(image_product), upsampled_region_size, upsample_factor, dftshift - shifts*upsample_factor))
+        maxima = np.array(np.unravel_index(np.argmax(cross_correlation), cross_correlation.shape), dtype=np.float64)
+        shifts += (maxima - dftshift)/upsample_factor
+
+    return -shifts[1], -shifts[0], peak
+
+def pyramid_roi(image, x0, y0, width, height, scale):
+    ''' Crop width x height full resolution pixels from (x0, y0) and decimate by scale.
+    '''
+    roi = np.float32(image[y0:y0 + height, x0:x0 + width])
+    if scale > 1:
+        roi = cv.resize(roi, (0, 0), fx=1/scale, fy=1/scale, interpolation=cv.INTER_AREA)
+    return roi
+
+def pyramid_registration(image_master, image_template, scales=(8, 4, 2, 1), roi_size=256, search=4, center=None, upsample_factor=10):
+    ''' Coarse-to-fine translation between two images.
+
+    The whole frame is registered at 1/scales[0], then each following scale only refines the
+    estimate by phase correlation of a roi_size ROI, so that the cost depends on the ROI and not on the frame.
+
+    Input:
+        - image_master: image before the displacement (ndarray).
+        - image_template: image after the displacement (ndarray).
+        - scales: decimation factors from the coarsest to the finest level, 1 being the full resolution (tuple[int]).
+        - roi_size: side of the ROI in pixels of each refinement level (int).
+        - search: largest correction in pixels accepted from a refinement level (float).
+        - center: center (x, y) of the ROI in the master in full resolution pixels, image center by default (tuple[float, float]).
+
+    Output:
+        - Displacement (x, y) of the image content from image_template to image_master in full resolution pixels (float, float).
+        - Phase correlation peak of the last accepted level (float).
+
+    Exemple:
+        shift_x, shift_y, peak = pyramid_registration(img1, img2)
+            -> 120.4, -35.1, 0.22
+    '''
+    if center == None:
+        center = (image_master.shape[1]/2, image_master.shape[0]/2)
+    # Keep the levels where the frame is still large enough to be registered
+    scales = [scale for scale in scales if min(image_master.shape[:2])//scale >= 32] or [1]
+
+    master   = cv.resize(np.float32(image_master),   (0, 0), fx=1/scales[0], fy=1/scales[0], interpolation=cv.INTER_AREA)
+    template = cv.resize(np.float32(image_template), (0, 0), fx=1/scales[0], fy=1/scales[0], interpolation=cv.INTER_AREA)
+    shift_x, shift_y, peak = phase_correlation(master, template, upsample_factor)
+    shift_x, shift_y = shift_x*scales[0], shift_y*scales[0]
+    logging.info('pyramid 1/' + str(scales[0]) + ' shift ' + number_format(shift_x) + ' ' + number_format(shift_y) + ' peak ' + number_format(peak))
+
+    for scale in scales[1:]:
+        # Same ROI size in both frames, small enough to be offset by the current estimate
+        width  = min(roi_size*scale, image_master.shape[1] - int(abs(shift_x)) - 1)
+        height = min(roi_size*scale, image_master.shape[0] - int(abs(shift_y)) - 1)
+        if min(width, height)//scale < 32:
+            break
+        # ROI around center in the master, offset by the estimate in the template, both inside their frame
+        offset_x, offset_y = int(round(shift_x)), int(round(shift_y))
+        xm = int(np.clip(round(center[0] - width/2), max(0, offset_x), image_master.shape[1] - width + min(0, offset_x)))
+        ym = int(np.clip(round(center[1] - height/2), max(0, offset_y), image_master.shape[0] - height + min(0, offset_y)))
+        xt, yt = xm - offset_x, ym - offset_y
+        master   = pyramid_roi(image_master, xm, ym, width, height, scale)
+        template = pyramid_roi(image_template, xt, yt, width, height, scale)
+        residual_x, residual_y, roi_peak = phase_correlation(master, template, upsample_factor)
+        if abs(residual_x) > search or abs(residual_y) > search:
+            logging.info('pyramid 1/' + str(scale) + ' correction out of the search window, estimate kept')
+            break
+        shift_x = xm - xt + residual_x*scale
+        shift_y = ym - yt + residual_y*scale
+        peak = roi_peak
+        logging.info('pyramid 1/' + str(scale) + ' shift ' + number_format(shift_x) + ' ' + number_format(shift_y) + ' peak ' + number_format(peak))
+
+    return shift_x, shift_y, peak
+
+"""
+Feature detectors
+    name: (factory, binary descriptors)
+"""
+feature_detectors = {
+    'SIFT':  (lambda: cv.SIFT_create(nfeatures=1000), False),
+    'ORB':   (lambda: cv.ORB_create(nfeatures=1000), True),
+    'AKAZE': (lambda: cv.AKAZE_create(), True),
+    'BRISK': (lambda: cv.BRISK_create(), True),
+    }
+# Guard against stripped OpenCV builds that lack some of the detectors
+feature_detectors = {name: value for name, value in feature_detectors.items() if hasattr(cv, name + '_create')}
+
+def denoise_nlmeans(img, microscope_type):
+    if microscope_type == 'ETEM':
+        return cv.fastNlMeansDenoising(img, None, h=20, templateWindowSize=7, searchWindowSize=21)
+    return cv.fastNlMeansDenoising(img, None, h=8, templateWindowSize=7, searchWindowSize=14)
+
+def denoise_binned(img, microscope_type, factor=2):
+    # 2x2 binning: features are detected on the smaller frame, features_create scales the keypoints back
+    return cv.resize(img, (img.shape[1]//factor, img.shape[0]//factor), interpolation=cv.INTER_AREA)
+
+"""
+Pre-match denoisers, applied to the resized 8 bits frame before feature detection
+    name: function(img, microscope_type) -> img
+    A denoiser may return a smaller frame (binning): the keypoints are scaled back to the input frame.
+"""
+denoisers = {
+    'nlmeans':   denoise_nlmeans,
+    'gaussian':  lambda img, microscope_type: cv.GaussianBlur(img, (0, 0), 1.5),
+    'bilateral': lambda img, microscope_type: cv.bilateralFilter(img, 5, 50, 5),
+    'median':    lambda img, microscope_type: cv.medianBlur(img, 5),
+    'binned':    denoise_binned,
+    'none':      lambda img, microscope_type: img,
+    }
+
+class match_statistics(object):
+    ''' Denoising time, match success rate and RANSAC inlier count per denoiser.
+
+    Exemple:
+        match_quality.summary()
+            -> {'nlmeans': {'frames': 40, 'denoise_ms': 180.2, 'matches': 39, 'success_rate': 0.97, 'mean_inliers': 212.4}}
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+
+    def entry(self, denoiser) -> dict:
+        return self.stats.setdefault(denoiser, {'frames': 0, 'denoise_time': 0., 'matches': 0, 'successes': 0, 'inliers': 0})
+
+    def add_frame(self, denoiser, denoise_time):
+        with self.lock:
+            entry = self.entry(denoiser)
+            entry['frames']       += 1
+            entry['denoise_time'] += denoise_time
+
+    def add_match(self, denoiser, success, inliers=0):
+        with self.lock:
+            entry = self.entry(denoiser)
+            entry['matches']   += 1
+            entry['successes'] += int(success)
+            entry['inliers']   += inliers
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {denoiser: {'frames':       entry['frames'],
+                               'denoise_ms':   1e3*entry['denoise_time']/max(1, entry['frames']),
+                               'matches':      entry['matches'],
+                               'success_rate': entry['successes']/max(1, entry['matches']),
+                               'mean_inliers': entry['inliers']/max(1, entry['successes'])}
+                    for denoiser, entry in self.stats.items()}
+
+match_quality = match_statistics()
+
+def features_create(microscope, img, resize_factor=1, detector='SIFT', denoiser='nlmeans'):
+    ''' Keypoints and descriptors of the denoised frame, with the denoising time in seconds.
+    '''
     img_ret = cv.resize(img, (0, 0), fx=resize_factor, fy=resize_factor)
-    if microscope.microscope_type == 'ETEM':
-        img_ret = cv.fastNlMeansDenoising(img_ret, None, h=20, templateWindowSize=7, searchWindowSize=21)
-    else:
-        img_ret = cv.fastNlMeansDenoising(img_ret, None, h=8, templateWindowSize=7, searchWindowSize=14)
-    sift = cv.SIFT_create(nfeatures=1000)
-    kp, des = sift.detectAndCompute(img_ret, None)
+    t0 = time.perf_counter()
+    img_den = denoisers[denoiser](img_ret, microscope.microscope_type)
+    denoise_time = time.perf_counter() - t0
+    kp, des = feature_detectors[detector][0]().detectAndCompute(img_den, None)
+    scale = img_ret.shape[1]/img_den.shape[1]
+    if scale != 1:
+        for point in kp:
+            point.pt   = ((point.pt[0] + 0.5)*scale - 0.5, (point.pt[1] + 0.5)*scale - 0.5) # pixel centres
+            point.size = point.size*scale
+    return kp, des, denoise_time
+
+def match_by_features_create(microscope, img, mid_strips=0, resize_factor=1, detector='SIFT', denoiser='nlmeans'):
+    kp, des, denoise_time = features_create(microscope, img, resize_factor, detector, denoiser)
+    match_quality.add_frame(denoiser, denoise_time)
     return kp, des
 
-def match_by_features(img_template, img_master, kp1, des1, kp2, des2, resize_factor, mid_strips_template, mid_strips_master, MIN_MATCH_COUNT = 20, path='data/tmp/'):
+def match_by_features_SIFT_create(microscope, img, mid_strips=0, resize_factor=1):
+    return match_by_features_create(microscope, img, mid_strips, resize_factor, 'SIFT')
+
+class feature_matcher(object):
+    ''' Matcher index trained once on reference descriptors, then queried repeatedly.
+
+    method is 'kdtree' (FLANN, float descriptors such as SIFT), 'lsh' (FLANN, binary descriptors)
+    or 'hamming' (brute force Hamming distance, binary descriptors). By default it is deduced
+    from the descriptor type at training.
+
+    Exemple:
+        matcher = feature_matcher(trees=5, checks=1).train(des_master)
+        matches = matcher.knn_match(des_template)
+    '''
     FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
-    search_params = dict(checks = 1)
-    flann = cv.FlannBasedMatcher(index_params, search_params)
+    FLANN_INDEX_LSH    = 6
+
+    def __init__(self, trees=5, checks=1, method=None):
+        self.trees      = trees
+        self.checks     = checks
+        self.method     = method
+        self.reference  = None
+        self.flann      = None
+
+    def train(self, des):
+        if self.method == None:
+            self.method = 'kdtree' if des.dtype == np.float32 else 'hamming'
+        if self.method == 'kdtree':
+            self.flann = cv.FlannBasedMatcher(dict(algorithm = self.FLANN_INDEX_KDTREE, trees = self.trees), dict(checks = self.checks))
+            self.reference = np.float32(des)
+        elif self.method == 'lsh':
+            self.flann = cv.FlannBasedMatcher(dict(algorithm = self.FLANN_INDEX_LSH, table_number = 6, key_size = 12, multi_probe_level = 1), dict(checks = self.checks))
+            self.reference = np.uint8(des)
+        else:
+            self.flann = cv.BFMatcher(cv.NORM_HAMMING)
+            self.reference = np.uint8(des)
+        self.flann.add([self.reference])
+        self.flann.train()
+        return self
+
+    def knn_match(self, des, k=2):
+        return self.flann.knnMatch(des.astype(self.reference.dtype, copy=False), k=k)
+
+class feature_store(object):
+    ''' Keypoints and descriptors of already processed frames, keyed by frame id.
+
+    Keypoints are kept as NumPy arrays (pt, size, angle, response, octave, class_id) next to the
+    descriptor matrix, so handing a frame over to the next iteration is a reference, not a copy.
+    Only the max_frames most recent frames are kept.
+
+    Exemple:
+        features = feature_store()
+        frame = features.extract(path, microscope, img, mid_strips, resize_factor)
+        frame['pt'], frame['des']
+            -> (1000, 2) float32 array, (1000, 128) float32 array
+    '''
+    def __init__(self, max_frames=16):
+        self.max_frames = max_frames
+        self.frames     = OrderedDict()
+        self.lock       = Lock()
+
+    def __contains__(self, frame_id):
+        return frame_id in self.frames
+
+    def get(self, frame_id):
+        with self.lock:
+            return self.frames.get(frame_id)
+
+    def put(self, frame_id, kp, des, detector='SIFT', denoiser='nlmeans') -> dict:
+        frame = self.to_arrays(kp, des)
+        frame['detector'] = detector
+        frame['denoiser'] = denoiser
+        return self.add(frame_id, frame)
+
+    def add(self, frame_id, frame) -> dict:
+        ''' Keep a frame already converted by to_arrays.
+        '''
+        if frame_id == None:
+            return frame
+        with self.lock:
+            self.frames[frame_id] = frame
+            self.frames.move_to_end(frame_id)
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+        return frame
+
+    def extract(self, frame_id, microscope, img, mid_strips=0, resize_factor=1, detector='SIFT', denoiser='nlmeans') -> dict:
+        ''' Features of the frame, computed only if frame_id was never processed with this detector and denoiser.
+        '''
+        frame = self.get(frame_id)
+        if frame is not None and frame['detector'] == detector and frame['denoiser'] == denoiser:
+            return frame
+        kp, des = match_by_features_create(microscope, img, mid_strips, resize_factor, detector, denoiser)
+        return self.put(frame_id, kp, des, detector, denoiser)
+
+    def matcher(self, frame, trees=5, checks=1) -> feature_matcher:
+        ''' Index trained on the descriptors of the frame, built on first use only.
+        '''
+        matcher = frame.get('matcher')
+        if matcher is None or (matcher.trees, matcher.checks) != (trees, checks):
+            matcher = feature_matcher(trees, checks).train(frame['des'])
+            frame['matcher'] = matcher
+        return matcher
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+
+    @staticmethod
+    def to_arrays(kp, des) -> dict:
+        n = len(kp)
+        frame = {'pt':       np.empty((n, 2), dtype=np.float32),
+                 'size':     np.empty(n, dtype=np.float32),
+                 'angle':    np.empty(n, dtype=np.float32),
+                 'response': np.empty(n, dtype=np.float32),
+                 'octave':   np.empty(n, dtype=np.int32),
+                 'class_id': np.empty(n, dtype=np.int32),
+                 'des':      des}
+        for i, k in enumerate(kp):
+            frame['pt'][i]       = k.pt
+            frame['size'][i]     = k.size
+            frame['angle'][i]    = k.angle
+            frame['response'][i] = k.response
+            frame['octave'][i]   = k.octave
+            frame['class_id'][i] = k.class_id
+        return frame
+
+    @staticmethod
+    def to_keypoints(frame) -> list:
+        ''' Rebuild cv.KeyPoint objects, only needed for drawing.
+        '''
+        return [cv.KeyPoint(x=float(pt[0]), y=float(pt[1]), size=float(size), angle=float(angle), response=float(response), octave=int(octave), class_id=int(class_id))
+                for pt, size, angle, response, octave, class_id in zip(frame['pt'], frame['size'], frame['angle'], frame['response'], frame['octave'], frame['class_id'])]
+
+features_cache = feature_store()
+
+def extract_features_shared(shm_name, shape, dtype, microscope_type, mid_strips, resize_factor, detector, denoiser='nlmeans') -> dict:
+    ''' Worker side of feature_pipeline: features of a frame read from shared memory, as feature_store arrays.
+    The denoising time goes back with the features: match_quality of the worker process is not the one of the acquisition.
+    '''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        kp, des, denoise_time = features_create(SimpleNamespace(microscope_type=microscope_type), img, resize_factor, detector, denoiser)
+        del img
+    finally:
+        shm.close()
+    frame = feature_store.to_arrays(kp, des)
+    frame['detector']     = detector
+    frame['denoiser']     = denoiser
+    frame['denoise_time'] = denoise_time
+    return frame
+
+def worker_processes_available() -> bool:
+    ''' Worker processes are started from sys.executable: not possible inside DigitalMicrograph,
+    whose executable is not a Python interpreter.
+    '''
+    if 'DigitalMicrograph' in sys.modules:
+        return False
+    return os.path.basename(sys.executable).lower().startswith('python')
+
+class feature_pipeline(object):
+    ''' Denoising and feature extraction in worker processes, while the acquisition goes on.
+
+    Frames are handed over through multiprocessing.shared_memory, only the keypoint arrays come back.
+    Results are collected by frame id into a feature_store, where the drift loop finds them.
+    The pool is started at the first submit and stopped by shutdown (end of a series, stop button).
+    Frames the drift loop skips are never collected: beyond max_pending, the oldest results are dropped.
+    Without worker processes (inside DigitalMicrograph), submit does nothing and the drift loop extracts the features itself.
+
+    Exemple:
+        features_pipeline.submit(frame_id, microscope, img, mid_strips, resize_factor)
+        ...
+        frame = features_pipeline.collect(frame_id)
+            -> same dict as features_cache.extract(frame_id, ...)
+    '''
+    def __init__(self, store, max_workers=None, max_pending=8):
+        self.store       = store
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self.max_pending = max_pending
+        self.enabled     = worker_processes_available()
+        self.pool        = None
+        self.pending     = {}
+        self.lock        = Lock()
+
+    def __contains__(self, frame_id):
+        return frame_id in self.pending
+
+    def submit(self, frame_id, microscope, img, mid_strips=0, resize_factor=1, detector='SIFT', denoiser='nlmeans'):
+        if self.enabled == False:
+            return None
+        img = np.ascontiguousarray(img)
+        with self.lock:
+            if frame_id in self.pending:
+                return self.pending[frame_id]
+            while len(self.pending) >= self.max_pending:
+                self.pending.pop(next(iter(self.pending))).cancel() # oldest frame, skipped by the drift loop
+            if self.pool == None:
+                self.pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+            np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[...] = img
+            try:
+                future = self.pool.submit(extract_features_shared, shm.name, img.shape, img.dtype.str, microscope.microscope_type, mid_strips, resize_factor, detector, denoiser)
+            except:
+                shm.close()
+                shm.unlink()
+                raise
+            future.add_done_callback(lambda _, shm=shm: (shm.close(), shm.unlink()))
+            self.pending[frame_id] = future
+        return future
+
+    def collect(self, frame_id, timeout=None) -> dict:
+        ''' Wait for the features of frame_id and keep them in the store. None if the frame was not submitted or failed.
+        '''
+        with self.lock:
+            future = self.pending.pop(frame_id, None)
+        if future == None:
+            return None
+        try:
+            frame = future.result(timeout)
+        except Exception as ex:
+            logging.info('Feature extraction failed for ' + str(frame_id) + ': ' + str(ex))
+            return None
+        match_quality.add_frame(frame['denoiser'], frame.pop('denoise_time'))
+        return self.store.add(frame_id, frame)
+
+    def discard(self, frame_id):
+        ''' Drop the features of a frame that will not be collected.
+        '''
+        with self.lock:
+            future = self.pending.pop(frame_id, None)
+        if future != None:
+            future.cancel()
+
+    def shutdown(self):
+        ''' Stop the worker processes, results not collected yet are dropped. The next submit starts a new pool.
+        '''
+        with self.lock:
+            pool, self.pool = self.pool, None
+            self.pending.clear()
+        if pool != None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+features_pipeline = feature_pipeline(features_cache)
+
+def draw_matches(img_template, img_master, pts1, pts2, good, mask, resize_factor):
+    ''' Template and master side by side with the RANSAC inliers in green (all matches without mask).
+    '''
+    draw_params = dict(matchColor = (0,255,0), # draw matches in green color
+                       singlePointColor = None,
+                       matchesMask = None if mask is None else mask.ravel().tolist(), # draw only inliers
+                       flags = 2)
+    img_master = cv.resize(img_master, (0, 0), fx=resize_factor, fy=resize_factor)
+    img_template = cv.resize(img_template, (0, 0), fx=resize_factor, fy=resize_factor)
+    return cv.drawMatches(img_template, cv.KeyPoint_convert(pts1), img_master, cv.KeyPoint_convert(pts2), good, None, **draw_params)
+
+def match_by_features(img_template, img_master, kp1, des1, kp2, des2, resize_factor, mid_strips_template, mid_strips_master, MIN_MATCH_COUNT = 20, path='data/tmp/', matcher=None, matcher_reference='master', trees=5, checks=1, denoiser=None):
+    ''' Displacement between two frames from their SIFT features (FLANN + RANSAC homography).
+
+    matcher is an optional feature_matcher already trained on the descriptors of the master
+    (matcher_reference='master', queried with des1) or of the template (matcher_reference='template',
+    queried with des2). Without it, an index with the given trees/checks is trained on des2.
+    With denoiser, the outcome and the inlier count are added to match_quality for this denoiser.
+    '''
     try:
-        matches = flann.knnMatch(des1, des2, k=2)
+        if matcher == None:
+            matcher = feature_matcher(trees, checks).train(des2)
+            matcher_reference = 'master'
+        if matcher_reference == 'master':
+            matches = matcher.knn_match(des1, k=2)
+        else:
+            matches = matcher.knn_match(des2, k=2)
     except:
+        if denoiser != None:
+            match_quality.add_match(denoiser, False)
         return 0, 0
 
     good = []
-    for m,n in matches:
-        if m.distance < 0.9*n.distance:
-            good.append(m)
+    for pair in matches:
+        if len(pair) == 2 and pair[0].distance < 0.9*pair[1].distance: # LSH may return a single neighbour
+            good.append(pair[0])
+    if matcher_reference != 'master': # back to template as query, master as train
+        good = [cv.DMatch(m.trainIdx, m.queryIdx, m.distance) for m in good]
+
+    # Keypoints may come from a feature_store (coordinates array) or straight from OpenCV
+    pts1 = kp1 if isinstance(kp1, np.ndarray) else cv.KeyPoint_convert(kp1)
+    pts2 = kp2 if isinstance(kp2, np.ndarray) else cv.KeyPoint_convert(kp2)
 
     if len(good)>=MIN_MATCH_COUNT:
-        src_pts = np.float32([kp1[m.queryIdx].pt for m in good]).reshape(-1,1,2)
-        dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1,1,2)
+        src_pts = pts1[[m.queryIdx for m in good]].reshape(-1,1,2)
+        dst_pts = pts2[[m.trainIdx for m in good]].reshape(-1,1,2)
         M, mask = cv.findHomography(src_pts, dst_pts, cv.RANSAC,5.0)
-        disp = cv.perspectiveTransform(np.float32([[0,0]]).reshape(-1,1,2),M)/resize_factor
-    else:
+    if len(good) < MIN_MATCH_COUNT or M is None:
         logging.info('Not enough match to perform homography: only ' + str(len(good)) + ' matches.')
+        diagnostics.submit(partial(draw_matches, img_template, img_master, pts1, pts2, good, None, resize_factor),
+                           path + '/' + str(time.time()) + '_failed.png', failed=True)
+        if denoiser != None:
+            match_quality.add_match(denoiser, False)
         return 0, 0
-    
-    matchesMask = mask.ravel().tolist()
-    
-    draw_params = dict(matchColor = (0,255,0), # draw matches in green color
-                       singlePointColor = None,
-                       matchesMask = matchesMask, # draw only inliers
-                       flags = 2)
-    
-    img_master = cv.resize(img_master, (0, 0), fx=resize_factor, fy=resize_factor)
-    img_template = cv.resize(img_template, (0, 0), fx=resize_factor, fy=resize_factor)
-
-    img3 = cv.drawMatches(img_template, kp1, img_master, kp2, good, None, **draw_params)
+    disp = cv.perspectiveTransform(np.float32([[0,0]]).reshape(-1,1,2),M)/resize_factor
 
-    plt.imshow(img3)
-    plt.savefig(path + '/' + str(time.time()) + '.png')
-    plt.clf()
+    diagnostics.submit(partial(draw_matches, img_template, img_master, pts1, pts2, good, mask, resize_factor),
+                       path + '/' + str(time.time()) + '.png')
 
     logging.info('disp ' + str(disp))
     match_x = round(-disp[0,0,0])
     match_y = round(disp[0,0,1] + mid_strips_master - mid_strips_template)
     logging.info('match_x ' + number_format(match_x) + ' match_y ' + number_format(match_y))
 
-    if match_x > img_master.shape[1] or match_y > img_master.shape[0]:
+    inliers = int(mask.sum())
+    success = inliers >= MIN_MATCH_COUNT # a zero displacement is a valid match
+    if match_x > img_master.shape[1]*resize_factor or match_y > img_master.shape[0]*resize_factor:
         match_x = 0
         match_y = 0
+        success = False
+    if denoiser != None:
+        match_quality.add_match(denoiser, success, inliers)
     return match_x, match_y
 
-def remove_strips(microscope, img, dwell_time):
-    img = np.asarray(img, dtype='int32')
-    w, _ = img.shape
-    scores = np.zeros(w//2, dtype='int32')
-    for i in range(w//2-1):
-        scores[i] = np.sum(abs(img[i+1] - img[i]))
-    min_val = np.min(scores)
-    max_val = np.max(scores)
-    scores = (scores[:-1] - min_val) / (max_val - min_val)
-    scores_peaks, _ = find_peaks(scores, prominence=(0.4,1))
-    if len(scores_peaks) == 0:
-        mid_strips = 0
+def strip_profile(img):
+    ''' Sum of the absolute differences between consecutive rows, computed in the dtype of the frame.
+    '''
+    if img.dtype in (np.uint8, np.uint16, np.float32, np.float64):
+        diff = cv.absdiff(img[1:], img[:-1])
     else:
-        mid_strips = scores_peaks[-1] + int(0.0512/(dwell_time*w)) # 0.0512 is the time before the movement stabilizes itself. Empirically determined.
+        diff = np.abs(np.diff(img.astype(np.int64), axis=0))
+    return diff.sum(axis=1, dtype=np.float64 if diff.dtype.kind == 'f' else np.int64)
+
+def strip_position(profile, dwell_time, height) -> int:
+    ''' Last row of the stage-settling strip from the row profile of the first half of the frame, 0 if there is none.
+    '''
+    max_val = max(np.max(profile, initial=0), 0)
+    if max_val == 0:
+        return 0
+    scores_peaks, _ = find_peaks(profile/max_val, prominence=(0.4,1))
+    if len(scores_peaks) == 0:
+        return 0
+    return int(scores_peaks[-1] + int(0.0512/(dwell_time*height))) # 0.0512 is the time before the movement stabilizes itself. Empirically determined.
+
+def remove_strips(microscope, img, dwell_time):
+    ''' Crop the rows acquired while the stage was settling and scale the frame to 8 bits.
+
+    Input:
+        - Microscope control class (class).
+        - Frame (ndarray).
+        - Dwell time in seconds (float).
+
+    Return:
+        - 8 bits frame without the strip (ndarray).
+        - Number of rows removed (int).
 
+    Exemple:
+        img_ret, mid_strips = remove_strips(microscope, img, 0.2e-6)
+    '''
+    img = np.asarray(img)
+    h = img.shape[0]
     if microscope.microscope_type == 'ETEM':
         mid_strips = 0
+    else:
+        mid_strips = strip_position(strip_profile(img[:h//2]), dwell_time, h)
+
     img_2 = img[mid_strips:,:]
-    img_ret = np.asarray(255*(img_2 - np.min(img_2))/(np.max(img_2)-np.min(img_2)), dtype='uint8')
+    min_val, max_val = float(np.min(img_2)), float(np.max(img_2))
+    alpha = 255/(max_val - min_val) if max_val > min_val else 0
+    img_ret = cv.convertScaleAbs(img_2, None, alpha, -min_val*alpha)
     return img_ret, mid_strips
 
 def blob_detection(img, mid_strips, resize_factor):
@@ -505,12 +1151,81 @@ def blob_detection(img, mid_strips, resize_factor):
     # plt.show()
     return cx, -cy
 
-def set_eucentric(microscope, positioner) -> int:
+def match_by_grid_prepare(microscope, img, mid_strips=0, resize_factor=1, frame_id=None):
+    # match() works on the raw frames, nothing to precompute
+    return None
+
+def match_by_grid(img_template, img_master, state_template, state_master, resize_factor, mid_strips_template, mid_strips_master, path='data/tmp/'):
+    dx, dy, corr = match(img_master, img_template, resize_factor=resize_factor)
+    logging.info('grid match ' + number_format(dx) + ' ' + number_format(dy) + ' corr ' + number_format(corr))
+    match_x = dy
+    match_y = -dx + mid_strips_master - mid_strips_template
+    if abs(match_x) > img_master.shape[1] or abs(match_y) > img_master.shape[0]:
+        return 0, 0
+    return match_x, match_y
+
+def match_by_phase_correlation_prepare(microscope, img, mid_strips=0, resize_factor=1, frame_id=None):
+    return cv.resize(np.float32(img), (0, 0), fx=resize_factor, fy=resize_factor)
+
+def match_by_phase_correlation(img_template, img_master, state_template, state_master, resize_factor, mid_strips_template, mid_strips_master, path='data/tmp/'):
+    shift_x, shift_y, peak = phase_correlation(state_master, state_template)
+    logging.info('phase correlation shift ' + number_format(shift_x) + ' ' + number_format(shift_y) + ' peak ' + number_format(peak))
+    match_x = -shift_x/resize_factor
+    match_y = shift_y/resize_factor + mid_strips_master - mid_strips_template
+    if abs(match_x) > img_master.shape[1] or abs(match_y) > img_master.shape[0]:
+        return 0, 0
+    return match_x, match_y
+
+def match_by_pyramid_prepare(microscope, img, mid_strips=0, resize_factor=1, frame_id=None):
+    # Works at full resolution on the raw frames, resize_factor is not used
+    return None
+
+def match_by_pyramid(img_template, img_master, state_template, state_master, resize_factor, mid_strips_template, mid_strips_master, path='data/tmp/'):
+    shift_x, shift_y, peak = pyramid_registration(img_master, img_template)
+    match_x = -shift_x
+    match_y = shift_y + mid_strips_master - mid_strips_template
+    if abs(match_x) > img_master.shape[1] or abs(match_y) > img_master.shape[0]:
+        return 0, 0
+    return match_x, match_y
+
+def match_by_features_prepare(microscope, img, mid_strips=0, resize_factor=1, frame_id=None, detector='SIFT', denoiser='nlmeans'):
+    if frame_id in features_pipeline:
+        features_pipeline.collect(frame_id) # extracted in a worker process while the next frame was acquired
+    frame = features_cache.extract(frame_id, microscope, img, mid_strips, resize_factor, detector, denoiser)
+    if frame['des'] is not None:
+        features_cache.matcher(frame) # the template is the next master: its index is built once, now
+    return frame
+
+def match_by_features_state(img_template, img_master, state_template, state_master, resize_factor, mid_strips_template, mid_strips_master, path='data/tmp/'):
+    if state_master['des'] is None or state_template['des'] is None:
+        return 0, 0
+    return match_by_features(img_template, img_master, state_template['pt'], state_template['des'], state_master['pt'], state_master['des'],
+                             resize_factor, mid_strips_template, mid_strips_master, path=path, matcher=features_cache.matcher(state_master),
+                             denoiser=state_template['denoiser'])
+
+"""
+Drift correction backends
+    name: (prepare, register)
+    prepare(microscope, img, mid_strips, resize_factor, frame_id) -> state of the frame, kept while it is the master
+    register(img_template, img_master, state_template, state_master, resize_factor, mid_strips_template, mid_strips_master, path) -> match_x, match_y in pixels
+"""
+drift_backends = {
+    'features': (match_by_features_prepare, match_by_features_state),
+    'grid':     (match_by_grid_prepare, match_by_grid),
+    'phase':    (match_by_phase_correlation_prepare, match_by_phase_correlation),
+    'pyramid':  (match_by_pyramid_prepare, match_by_pyramid),
+    }
+for name in feature_detectors:
+    if name != 'SIFT':
+        drift_backends[name.lower()] = (partial(match_by_features_prepare, detector=name), match_by_features_state)
+
+def set_eucentric(microscope, positioner, drift_backend='features') -> int:
     ''' Set eucentric point according to the image centered features.
 
     Input:
         - Microscope control class (class).
         - Positioner control class (class).
+        - Name of the registration backend in drift_backends (str).
 
     Return:
         - Success or error code (int).
@@ -519,11 +1234,14 @@ def set_eucentric(microscope, positioner) -> int:
         set_eucentric_status = set_eucentric()
             -> 0    
     '''
-    x0, y0, z0, a0, _ = positioner.current_position()
+    x0, y0, z0, a0, _ = positioner.position()
     if z0 == None or y0 == None or a0 == None:
         logging.info('Error. Positioner is not initialized.')
         return 1
     
+    # Resolution or HFW may have been changed on the microscope UI since the cached values were read
+    microscope.invalidate_state()
+
     angle_step      =  1  # °
     angle_max       = 10  # °
     precision       = 5   # pixels
@@ -537,6 +1255,7 @@ def set_eucentric(microscope, positioner) -> int:
     displacement    = [[0,0]]
     angle           = [0]
     resize_factor   = 1
+    drift_prepare, drift_register = drift_backends[drift_backend]
 
     # HAADF analysis
     if microscope.microscope_type == 'ESEM':
@@ -553,31 +1272,30 @@ def set_eucentric(microscope, positioner) -> int:
         img_master = (image_euc[0]/256).astype('uint8')
     else:
         img_master = image_euc[0].astype('uint8')
-        
-    kp2, des2 = match_by_features_SIFT_create(microscope, img_master, 0, resize_factor)     
 
-    path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.current_position()[3])/1000000)
+    path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.position()[3])/1000000)
+    master = drift_prepare(microscope, img_master, 0, resize_factor, frame_id=path)
     microscope.save(img_tmp, path)
 
     positioner.relative_move(0, 0, 0, angle_step, 0, hold=True)
     hfw = microscope.horizontal_field_view() # meters
+    pos = positioner.position() # one reading per step
 
-    while abs(eucentric_error) > precision or positioner.current_position()[3] < angle_max:
-        logging.info('eucentric_error =' + number_format(eucentric_error) + 'precision =' + number_format(precision) + 'current angle =' + number_format(positioner.current_position()[3]) + 'angle_max =' + number_format(angle_max))
+    while abs(eucentric_error) > precision or pos[3] < angle_max:
+        logging.info('eucentric_error =' + number_format(eucentric_error) + 'precision =' + number_format(precision) + 'current angle =' + number_format(pos[3]) + 'angle_max =' + number_format(angle_max))
 
         img_tmp      = microscope.acquire_frame(resolution, dwell_time, bit_depth)
         image_euc[1] = microscope.image_array(img_tmp)
     
-        path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.current_position()[3]))
+        path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(pos[3]))
         microscope.save(img_tmp, path)
         
         if np.max(image_euc[1]) > 255:
             img_template = (image_euc[1]/256).astype('uint8')
         else:
             img_template = image_euc[1].astype('uint8')
-        kp1, des1 = match_by_features_SIFT_create(microscope, img_template, 0, resize_factor)
-
-        dx_pix, dy_pix = match_by_features(img_template, img_master, kp1, des1, kp2, des2, resize_factor, 0, 0)
+        template = drift_prepare(microscope, img_template, 0, resize_factor, frame_id=path)
+        dx_pix, dy_pix = drift_register(img_template, img_master, template, master, resize_factor, 0, 0)
 
         dx_si = dx_pix*hfw/image_width
         dy_si = dy_pix*hfw/image_width
@@ -585,20 +1303,21 @@ def set_eucentric(microscope, positioner) -> int:
         logging.info('dx_pix, dy_pix' + number_format(dx_pix) + number_format(dy_pix) + 'dx_si, dy_si' + number_format(dx_si) + number_format(dy_si))
 
         displacement.append([displacement[-1][0] + dx_si, displacement[-1][1] + dy_si])
-        angle.append(positioner.current_position()[3])
+        angle.append(pos[3])
 
         eucentric_error += abs(dy_pix)
 
-        if abs(positioner.current_position()[3]) >= angle_max - 0.01: # 0.010000 degree of freedom
+        if abs(pos[3]) >= angle_max - 0.01: # 0.010000 degree of freedom
             '''If out of the angle range'''
             correct_eucentric(microscope, positioner, displacement, angle)
             
-            ixe, ygrec, zed, _, _ = positioner.current_position()
+            ixe, ygrec, zed, _, _ = positioner.position()
             positioner.absolute_move(ixe, ygrec, zed, -2*angle_step, 0)
             positioner.absolute_move(ixe, ygrec, zed, 0, 0)
+            pos = positioner.position()
             
             displacement  = [[0,0]]
-            angle = [positioner.current_position()[3]]
+            angle = [pos[3]]
             eucentric_error = 0
             
             if microscope.microscope_type == 'ESEM':
@@ -618,18 +1337,19 @@ def set_eucentric(microscope, positioner) -> int:
                 img_master = (image_euc[0]/256).astype('uint8')
             else:
                 img_master = image_euc[0].astype('uint8')
-            kp2, des2 = match_by_features_SIFT_create(microscope, img_master, 0, resize_factor)     
-            path = 'data/tmp/' + str(round(time.time())) + 'img_' + str(round(positioner.current_position()[3]))
+            path = 'data/tmp/' + str(round(time.time())) + 'img_' + str(round(pos[3]))
+            master = drift_prepare(microscope, img_master, 0, resize_factor, frame_id=path)
             microscope.save(img_tmp, path)
             positioner.relative_move(0, 0, 0, angle_step, 0, hold=True)
+            pos = positioner.position()
             continue
 
         positioner.relative_move(0, 0, 0, angle_step, 0, hold=True)
-        kp2 = cv2_copy(kp1)
-        des2 = deepcopy(des1)
-        img_master = deepcopy(img_template)
+        pos = positioner.position()
+        master = template
+        img_master = img_template
 
-    ixe, ygrec, zed, _, _ = positioner.current_position()
+    ixe, ygrec, zed, _, _ = pos
     positioner.absolute_move(ixe, ygrec, zed, 0, 0)
     logging.info('Done eucentrixx')
     copyfile('last_execution.log', 'data/tmp/log' + str(time.time()) + '.txt')
@@ -649,7 +1369,7 @@ def set_eucentric_ETEM(microscope, positioner) -> int:
         set_eucentric_status = set_eucentric()
             -> 0    
     '''
-    x0, y0, z0, a0, _ = positioner.current_position()
+    x0, y0, z0, a0, _ = positioner.position()
     if z0 == None or y0 == None or a0 == None:
         logging.info('Error. Positioner is not initialized.')
         return 1
@@ -672,19 +1392,20 @@ def set_eucentric_ETEM(microscope, positioner) -> int:
     microscope.start_acquisition()
     img_tmp      = microscope.acquire_frame(resolution, dwell_time, bit_depth)
     image_euc[0] = microscope.image_array(img_tmp)
-    path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.current_position()[3])/1000000)
+    path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.position()[3])/1000000)
     microscope.save(img_tmp, path)
 
     positioner.relative_move(0, 0, 0, angle_step, 0, hold=True)
     hfw = microscope.horizontal_field_view() # meters
+    pos = positioner.position() # one reading per step
     
-    while abs(eucentric_error) > precision or positioner.current_position()[3] < angle_max:
-        logging.info('eucentric_error =' + number_format(eucentric_error) + 'precision =' + number_format(precision) + 'current angle =' + number_format(positioner.current_position()[3]) + 'angle_max =' + number_format(angle_max))
+    while abs(eucentric_error) > precision or pos[3] < angle_max:
+        logging.info('eucentric_error =' + number_format(eucentric_error) + 'precision =' + number_format(precision) + 'current angle =' + number_format(pos[3]) + 'angle_max =' + number_format(angle_max))
         
         img_tmp      = microscope.acquire_frame(resolution, dwell_time, bit_depth)
         image_euc[1] = microscope.image_array(img_tmp)
 
-        path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.current_position()[3]))
+        path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(pos[3]))
         microscope.save(img_tmp, path)
         
         img_master, mid_strips_master = remove_strips(image_euc[0], dwell_time)
@@ -698,25 +1419,26 @@ def set_eucentric_ETEM(microscope, positioner) -> int:
         logging.info('dx_pix, dy_pix' + number_format(dx_pix) + number_format(dy_pix) + 'dx_si, dy_si' + number_format(dx_si) + number_format(dy_si))
 
         displacement.append([displacement[-1][0] + dx_si, displacement[-1][1] + dy_si])
-        angle.append(positioner.current_position()[3])
+        angle.append(pos[3])
 
         if microscope.microscope_type == 'ESEM':
             eucentric_error += abs(dx_pix)
         else:
             eucentric_error += abs(dy_pix)
 
-        if abs(positioner.current_position()[3]) >= angle_max - 0.01: # 0.010000 degree of freedom
+        if abs(pos[3]) >= angle_max - 0.01: # 0.010000 degree of freedom
             '''If out of the angle range'''
             correct_eucentric(microscope, positioner, displacement, angle)
             logging.info('Start again with negative angles')
             
             displacement  = [[0,0]]
-            ixe, ygrec, zed, _, _ = positioner.current_position()
+            ixe, ygrec, zed, _, _ = positioner.position()
             positioner.absolute_move(ixe, ygrec, zed, -angle_step, 0)
             positioner.absolute_move(ixe, ygrec, zed, 0, 0)
+            pos = positioner.position()
             
             # direction      *= -1
-            angle           = [positioner.current_position()[3]]
+            angle           = [pos[3]]
             eucentric_error = 0
             
             ### Test increase angle
@@ -726,20 +1448,283 @@ def set_eucentric_ETEM(microscope, positioner) -> int:
             
             img_tmp = microscope.acquire_frame(resolution, dwell_time, bit_depth)
             image_euc[0] = microscope.image_array(img_tmp)
-            path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(positioner.current_position()[3]))
+            path = 'data/tmp/' + str(round(time.time(),1)) + 'img_' + str(round(pos[3]))
             microscope.save(img_tmp, path)
             positioner.relative_move(0, 0, 0, angle_step, 0, hold=True)
+            pos = positioner.position()
             continue
         
         positioner.relative_move(0, 0, 0, angle_step, 0, hold=True)
+        pos = positioner.position()
         image_euc[0] = np.ndarray.copy(image_euc[1])
 
-    ixe, ygrec, zed, _, _ = positioner.current_position()
+    ixe, ygrec, zed, _, _ = pos
     positioner.absolute_move(ixe, ygrec, zed, 0, 0)
     logging.info('Done eucentrixx')
     copyfile('last_execution.log', 'data/tmp/log' + str(time.time()) + '.txt')
     return 0
 
+class frame_bus(object):
+    ''' Bounded ring of the last acquired frames, shared in memory between the acquisition and the correction threads.
+
+    Each frame is a dict: index, image (ndarray), path (saved file without extension), tilt (°),
+    beam_shift, t_start and t_end (acquisition timestamps in s). Frames older than capacity are dropped.
+
+    Exemple:
+        frames = frame_bus()
+        frames.publish(img, path=path, tilt=tangle, beam_shift=microscope.beam_shift(), t_start=t0)
+        frame = frames.wait(after=last_index, timeout=0.1)
+            -> newest frame with an index above last_index, None on timeout
+    '''
+    def __init__(self, capacity=8):
+        self.frames     = deque(maxlen=capacity)
+        self.condition  = Condition()
+        self.next_index = 0
+        self.closed     = False
+
+    def publish(self, image, **metadata) -> dict:
+        with self.condition:
+            frame = dict(metadata, index=self.next_index, image=image)
+            frame.setdefault('t_end', time.time())
+            self.next_index += 1
+            self.frames.append(frame)
+            self.condition.notify_all()
+        return frame
+
+    def latest(self) -> dict:
+        with self.condition:
+            return self.frames[-1] if len(self.frames) > 0 else None
+
+    def get(self, index) -> dict:
+        ''' Frame of this index, None if it was never published or already dropped.
+        '''
+        with self.condition:
+            for frame in self.frames:
+                if frame['index'] == index:
+                    return frame
+        return None
+
+    def wait(self, after=-1, timeout=None) -> dict:
+        ''' Newest frame with an index above after, waiting for it if needed. None on timeout or once closed.
+        '''
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or (len(self.frames) > 0 and self.frames[-1]['index'] > after), timeout)
+            if len(self.frames) > 0 and self.frames[-1]['index'] > after:
+                return self.frames[-1]
+        return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class angle_track(object):
+    ''' Timestamped tilt angles of a rotating stage, interpolated at any time.
+
+    Exemple:
+        track = angle_track()
+        track.sample(positioner)
+        ... # acquisition
+        track.sample(positioner)
+        tangle = track.at(t_middle_of_scan)
+    '''
+    def __init__(self, maxlen=64):
+        self.samples = deque(maxlen=maxlen)
+
+    def sample(self, positioner) -> float:
+        pos = positioner.position()
+        self.samples.append((getattr(pos, 't', time.time()), pos[3]))
+        return pos[3]
+
+    def at(self, t) -> float:
+        times, angles = np.array(self.samples, dtype=np.float64).T
+        if len(times) == 1:
+            return float(angles[0])
+        if times[0] <= t <= times[-1]:
+            return float(np.interp(t, times, angles))
+        # Outside of the samples: linear extrapolation from the two nearest ones (constant velocity)
+        k = 0 if t < times[0] else len(times) - 2
+        if times[k+1] == times[k]:
+            return float(angles[k])
+        return float(angles[k] + (angles[k+1] - angles[k])*(t - times[k])/(times[k+1] - times[k]))
+
+class frame_writer(object):
+    ''' Pool of threads saving the acquired frames, so that storage latency stays out of the tilt cycle.
+
+    The queue is bounded: when the disk falls behind, submit blocks until a slot is free (backpressure).
+    Frames are written in submission order only with workers=1. With several workers, two frames can be
+    saved at the same time and complete out of order (each frame has its own file).
+
+    Exemple:
+        writer = frame_writer(microscope.save, workers=2)
+        writer.submit(image, path)
+        writer.close()
+            -> returns once every submitted frame is on disk
+    '''
+    def __init__(self, save, workers=2, maxsize=4):
+        self.save    = save
+        self.queue   = queue.Queue(maxsize=maxsize)
+        self.stats   = {'submitted': 0, 'written': 0, 'errors': 0, 'blocked_time': 0.}
+        self.threads = [Thread(target=self.run, name='frame_writer_' + str(i), daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, image, path):
+        t0 = time.perf_counter()
+        self.queue.put((image, path))
+        self.stats['submitted']    += 1
+        self.stats['blocked_time'] += time.perf_counter() - t0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None:
+                    return
+                image, path = item
+                self.save(image, path)
+                self.stats['written'] += 1
+            except Exception as ex:
+                self.stats['errors'] += 1
+                logging.info('Frame not saved ' + str(item[1]) + ': ' + str(ex))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        ''' Wait for every submitted frame to be saved.
+        '''
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        logging.info('frame writer ' + str(self.stats))
+
+class stage_graph(object):
+    ''' Stages with explicit dependencies, each one started in a thread pool as soon as all its dependencies are done.
+
+    Stages without dependency between them overlap. Start and end times of every stage are kept
+    to log the timings and the critical path. A stage whose dependency failed is not run and fails too.
+    The result of a released stage is dropped once it is done and all its dependents have started:
+    only its timings are kept, a tilt series does not hold all its frames.
+
+    Exemple:
+        graph = stage_graph()
+        graph.add('acquire_1', acquire)
+        graph.add('save_1', save, after=['acquire_1'])
+        graph.wait('save_1')
+        graph.release('acquire_1', 'save_1')
+        graph.critical_path('save_1')
+            -> ['acquire_1', 'save_1']
+    '''
+    def __init__(self, workers=4):
+        self.pool    = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='stage')
+        self.t0      = time.perf_counter()
+        self.lock    = Lock()
+        self.stages  = {}
+
+    def add(self, name, function, after=()) -> Future:
+        ''' Run function(*results of after) once the stages of after are done.
+        The stages of after must not be released yet.
+        '''
+        future = Future()
+        with self.lock:
+            after = [dep for dep in after if dep in self.stages]
+            deps  = [self.stages[dep]['future'] for dep in after]
+            for dep in after:
+                self.stages[dep]['dependents'] += 1
+            self.stages[name] = {'future': future, 'after': after, 'start': None, 'end': None, 'dependents': 0, 'released': False}
+        remaining = [len(deps)]
+
+        def start(_=None):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            failed = [dep for dep in deps if dep.exception() != None]
+            if failed:
+                future.set_exception(failed[0].exception())
+            else:
+                self.pool.submit(self.run, name, function, [dep.result() for dep in deps])
+            # The dependencies are not needed anymore, the done callbacks of their futures keep this closure
+            del deps[:]
+            for dep in after:
+                with self.lock:
+                    self.stages[dep]['dependents'] -= 1
+                self.drop(dep)
+            if failed:
+                self.drop(name)
+
+        if len(deps) == 0:
+            remaining[0] = 1
+            start()
+        for dep in deps:
+            dep.add_done_callback(start)
+        return future
+
+    def run(self, name, function, args):
+        stage = self.stages[name]
+        stage['start'] = time.perf_counter() - self.t0
+        try:
+            result = function(*args)
+        except Exception as ex:
+            stage['end'] = time.perf_counter() - self.t0
+            logging.info('stage ' + name + ' failed: ' + str(ex))
+            stage['future'].set_exception(ex)
+            return
+        stage['end'] = time.perf_counter() - self.t0
+        ready = max([self.stages[dep]['end'] for dep in stage['after']], default=0)
+        logging.info('stage {} {:.3f} s, started {:.3f} s after its dependencies'.format(name, stage['end'] - stage['start'], stage['start'] - ready))
+        stage['future'].set_result(result)
+        self.drop(name)
+
+    def release(self, *names):
+        ''' No stage added from now on depends on names: their results are dropped once their dependents have started.
+        '''
+        for name in names:
+            if name in self.stages:
+                self.stages[name]['released'] = True
+                self.drop(name)
+
+    def drop(self, name):
+        with self.lock:
+            stage = self.stages[name]
+            if stage['released'] and stage['dependents'] == 0 and stage['future'] != None and stage['future'].done():
+                stage['future'] = None
+
+    def wait(self, name, timeout=None):
+        ''' Result of the stage, None once it has been dropped.
+        '''
+        future = self.stages[name]['future']
+        if future == None:
+            return None
+        return future.result(timeout)
+
+    def critical_path(self, name=None) -> list:
+        ''' Chain of stages ending at name (the last stage to finish by default), following the dependency that finished last.
+        '''
+        if name == None:
+            name = max(self.stages, key=lambda stage: self.stages[stage]['end'] or 0)
+        path = [name]
+        while len(self.stages[path[-1]]['after']) > 0:
+            path.append(max(self.stages[path[-1]]['after'], key=lambda dep: self.stages[dep]['end'] or 0))
+        return path[::-1]
+
+    def summary(self) -> dict:
+        ''' Mean duration in seconds of each kind of stage, the kind being the name up to the last '_'.
+        '''
+        durations = {}
+        for name, stage in self.stages.items():
+            if stage['end'] != None and stage['start'] != None:
+                durations.setdefault(name.rsplit('_', 1)[0], []).append(stage['end'] - stage['start'])
+        return {kind: sum(values)/len(values) for kind, values in durations.items()}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
 class acquisition(object):
     
     def __init__(self,
@@ -754,7 +1739,13 @@ class acquisition(object):
                 tilt_end=60,
                 drift_correction=False,
                 focus_correction=False,
-                square_area=False) -> int:
+                square_area=False,
+                drift_backend='features',
+                pipeline=False,
+                denoiser='nlmeans',
+                scheduler=False,
+                settle_time=0,
+                continuous=False) -> int:
         '''
         '''
         
@@ -765,6 +1756,9 @@ class acquisition(object):
         imgID = 0
         
         self.c = Condition()
+        self.frames = frame_bus()
+        self.writer = None
+        self.writer_lock = Lock()
         
         try:
             self.microscope = microscope
@@ -778,11 +1772,24 @@ class acquisition(object):
             self.drift_correction = drift_correction
             self.focus_correction = focus_correction
             self.square_area = square_area
+            self.drift_backend = drift_backend
+            self.pipeline = pipeline
+            self.denoiser = denoiser
+            self.scheduler = scheduler
+            self.settle_time = settle_time
+            self.continuous = continuous
         except:
             self.microscope       = 0
             self.positioner       = 0
 
-        self.pos = positioner.current_position()
+        if drift_backend not in drift_backends:
+            logging.info('Unknown drift backend ' + str(drift_backend) + '. Features are used.')
+            self.drift_backend = 'features'
+        if denoiser not in denoisers:
+            logging.info('Unknown denoiser ' + str(denoiser) + '. NL-means is used.')
+            self.denoiser = 'nlmeans'
+
+        self.pos = positioner.position()
         if None in self.pos[1:-1]:
             return None
 
@@ -795,6 +1802,56 @@ class acquisition(object):
         logging.info('path = ' + self.path)
         os.makedirs(self.path, exist_ok=True)
 
+    def start_writer(self) -> frame_writer:
+        with self.writer_lock:
+            if self.writer == None:
+                # DigitalMicrograph saves are kept on a single thread
+                self.writer = frame_writer(self.microscope.save, workers=1 if self.microscope.microscope_type == 'ETEM' else 2)
+            return self.writer
+
+    def stop_writer(self):
+        ''' Flush the frames still queued for saving and stop the writer threads.
+        Called from the GUI and from the acquisition thread: the writer is taken under the lock, so only one caller closes it.
+        '''
+        with self.writer_lock:
+            writer, self.writer = self.writer, None
+        if writer != None:
+            writer.close()
+
+    def frame_to_save(self, image, frame):
+        ''' Image handed to the writer thread.
+        DigitalMicrograph refills the same image at every acquisition: on ETEM a copy of the frame is saved instead,
+        with the calibration and the tags of the acquisition. Called before the next acquisition.
+        '''
+        if self.microscope.microscope_type == 'ETEM':
+            return self.microscope.frame_copy(image, frame['image'])
+        return image
+
+    def drift_resize_factor(self) -> float:
+        if self.microscope.microscope_type == 'ESEM':
+            resize = 410 # width of images for match analysis
+            return resize/float(self.image_width)
+        return 1
+
+    def drift_frame(self, img):
+        ''' Frame as seen by the drift correction: square area if requested, strips removed, 8 bits.
+        '''
+        if self.square_area == True:
+            dim_max = max(int(self.image_width), int(self.image_height))
+            dim_min = min(int(self.image_width), int(self.image_height))
+            img = img[0:dim_max, (dim_max - dim_min)//2:(dim_max + dim_min)//2]
+        return remove_strips(self.microscope, img, self.dwell_time)
+
+    def drift_detector(self):
+        ''' Feature detector of the drift backend, None if the backend does not use features.
+        '''
+        prepare = drift_backends[self.drift_backend][0]
+        if prepare is match_by_features_prepare:
+            return 'SIFT'
+        if isinstance(prepare, partial) and prepare.func is match_by_features_prepare:
+            return prepare.keywords['detector']
+        return None
+
     def set_eucentric_test(self) -> int:
         resolution      = "1536x1024" # Bigger pixels means less noise and better match
         dwell_time      = 2e-6
@@ -814,11 +1871,10 @@ class acquisition(object):
         self.positioner.absolute_move(ixe, ygrec, zed, 0, 0)
         return 0
 
-    def tomo(self):
-        self.c.acquire()
-        self.microscope.start_acquisition()
-
-        if self.positioner.current_position()[3] > 0:
+    def tilt_series_start(self) -> int:
+        ''' Tilt direction from the current angle, ESEM tilt correction on. Return the number of images.
+        '''
+        if self.pos[3] > 0:
             self.direction = -1
             if self.tilt_end > 0:
                 self.tilt_end *= -1
@@ -832,17 +1888,33 @@ class acquisition(object):
 
         if self.microscope.microscope_type == 'ESEM':
             self.microscope.tilt_correction(ONOFF=True)
+        return nb_images
+
+    def tomo(self):
+        if self.continuous == True:
+            return self.tomo_continuous()
+        if self.scheduler == True:
+            return self.tomo_graph()
+        self.c.acquire()
+        self.microscope.start_acquisition()
+        writer = self.start_writer()
+        nb_images = self.tilt_series_start()
+        move = None
         
         for i in range(1, nb_images+1):
             if self.flag == 1:
                 self.c.notify_all()
                 self.c.release()
+                if move != None:
+                    move.wait()
                 return
             if self.flag == 2:
                 self.c.wait()
 
-            
-            tangle = self.positioner.current_position()[3]
+            # The tilt runs during the save and the registration of the previous frame
+            if move != None:
+                move.wait()
+            tangle = self.positioner.position()[3]
             
             logging.info('Image {} / {}. Current tilt angle = {}'.format(i, nb_images, number_format(tangle)))
             
@@ -850,166 +1922,383 @@ class acquisition(object):
                 self.microscope.tilt_correction(value = -tangle*np.pi/180) # Tilt correction for e- beam
 
             # logging.info(str(i) + str(self.positioner.current_position()[3]))
+            t_start = time.time()
             image = self.microscope.acquire_frame(self.resolution, self.dwell_time, self.bit_depth, square_area=True)
             # images[0].save(self.path + '/SE_'    + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle)) + '.tif')
             # images[1].save(self.path + '/BF_'    + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle)) + '.tif')
-            
-            a = self.positioner.relative_move(0, 0, 0, self.direction*self.tilt_increment, 0)
-
             path = self.path + '/HAADF_' + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle))
-            self.microscope.save(image, path)
+            frame = self.frames.publish(np.array(self.microscope.image_array(image)), path=path, tilt=tangle, beam_shift=self.microscope.beam_shift(), t_start=t_start)
+
+            # Features of the frame are extracted in a worker process during the tilt and the next acquisition
+            if self.pipeline == True and self.drift_correction == True and self.drift_detector() != None:
+                img_drift, mid_strips = self.drift_frame(frame['image'])
+                features_pipeline.submit(path, self.microscope, img_drift, mid_strips, self.drift_resize_factor(), self.drift_detector(), self.denoiser)
+
+            move = self.positioner.relative_move_async(0, 0, 0, self.direction*self.tilt_increment, 0)
+
+            writer.submit(self.frame_to_save(image, frame), path)
 
             if self.drift_correction == True or self.focus_correction == True:
                 self.c.notify_all()
                 self.c.wait()
             
+        self.flag = 1
+        self.frames.close()
         self.c.notify_all()
         self.c.release()    
-        self.flag = 1
+        if move != None:
+            move.wait()
+        self.stop_writer()
+        features_pipeline.shutdown()
         logging.info('Tomography is a Success')
         return 0
 
-    def f_drift_correction(self):
+    def scan_time(self, t_start, t_end) -> float:
+        ''' Duration of the scan of the last frame: from the scan settings if the microscope knows it, else measured.
         '''
+        if hasattr(self.microscope, 'frame_time'):
+            image_width, image_height = int(self.image_width), int(self.image_height)
+            width = min(image_width, image_height)/max(image_width, image_height) if self.square_area == True else 1
+            return self.microscope.frame_time(self.resolution, self.dwell_time, width)
+        return t_end - t_start
+
+    def tomo_continuous(self):
+        ''' Tilt series with the tilt rotating at constant velocity while the frames stream in.
+
+        The first two frames are taken at the start angle: their period sets the velocity, so that
+        consecutive frames are about tilt_increment apart. The angle of each frame is interpolated
+        at the middle of its scan from the positions sampled around each acquisition. Drift
+        correction runs on the stream as in record().
         '''
+        if not hasattr(self.positioner, 'rotate'):
+            logging.info('Continuous tilt needs a positioner with velocity control')
+            with self.c:
+                self.flag = 1
+                self.frames.close()
+                self.c.notify_all()
+            return 1
         self.c.acquire()
+        self.microscope.start_acquisition()
+        writer = self.start_writer()
+        self.tilt_series_start()
+        track = angle_track()
+        rotation = None
+        velocity = None
+        t_end_previous = None
+        i = 0
 
-        anticipation_x   = 0
-        anticipation_y   = 0
-        correction_x     = 0
-        correction_y     = 0
+        while rotation == None or not rotation.done():
+            if self.flag == 1:
+                break
+            if self.flag == 2:
+                if rotation != None:
+                    self.positioner.stop()
+                    rotation.wait()
+                    rotation = None
+                self.c.wait()
+                continue
 
-        if self.microscope.microscope_type == 'ESEM':
-            resize = 410 # width of images for match analysis
-            # resize = -1
-            # resize_factor = 1
-            resize_factor = resize/float(self.image_width)
-            logging.info('resize_factor = ' + number_format(resize_factor))
-        else:
-            resize = -1
-            resize_factor = 1                      
+            i += 1
+            tangle = track.sample(self.positioner)
+            if self.microscope.microscope_type == 'ESEM':
+                self.microscope.tilt_correction(value = -tangle*np.pi/180) # Tilt correction for e- beam
+
+            t_start = time.time()
+            image = self.microscope.acquire_frame(self.resolution, self.dwell_time, self.bit_depth, square_area=True)
+            t_end = time.time()
+            track.sample(self.positioner)
+            scan_time = self.scan_time(t_start, t_end)
+            tangle = track.at(t_end - scan_time/2)
+            logging.info('Image {}. Tilt angle at mid-scan = {}'.format(i, number_format(tangle)))
+
+            path = self.path + '/HAADF_' + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle))
+            frame = self.frames.publish(np.array(self.microscope.image_array(image)), path=path, tilt=tangle, beam_shift=self.microscope.beam_shift(), t_start=t_end - scan_time, t_end=t_end)
+            if self.pipeline == True and self.drift_correction == True and self.drift_detector() != None:
+                img_drift, mid_strips = self.drift_frame(frame['image'])
+                features_pipeline.submit(path, self.microscope, img_drift, mid_strips, self.drift_resize_factor(), self.drift_detector(), self.denoiser)
+            writer.submit(self.frame_to_save(image, frame), path)
+
+            if velocity == None and t_end_previous != None:
+                velocity = self.tilt_increment/(t_end - t_end_previous)
+                logging.info('Continuous tilt at ' + number_format(velocity) + ' deg/s')
+            if rotation == None and velocity != None:
+                rotation = self.positioner.rotate(self.tilt_end, velocity)
+            t_end_previous = t_end
+
+            if self.drift_correction == True or self.focus_correction == True:
+                self.c.notify_all()
+                self.c.wait()
+
+        if rotation != None and not rotation.done():
+            self.positioner.stop()
+        self.flag = 1
+        self.frames.close()
+        self.c.notify_all()
+        self.c.release()
+        if rotation != None:
+            rotation.wait()
+        self.stop_writer()
+        features_pipeline.shutdown()
+        logging.info('Tomography is a Success')
+        return 0
+
+    def tomo_graph(self):
+        ''' Tilt series as a stage graph: move, settle, acquire, save, register, correct.
+
+        Frame N is saved and registered while the stage moves to the next tilt. Frame N+1 is acquired
+        once the stage has settled and the correction computed from frame N is applied.
+        '''
+        self.microscope.start_acquisition()
+        nb_images = self.tilt_series_start()
+        if self.drift_correction == True:
+            self.drift_start()
+        graph = stage_graph()
+
+        def acquire(i):
+            tangle = self.positioner.position()[3]
+            logging.info('Image {} / {}. Current tilt angle = {}'.format(i, nb_images, number_format(tangle)))
+            if self.microscope.microscope_type == 'ESEM':
+                self.microscope.tilt_correction(value = -tangle*np.pi/180) # Tilt correction for e- beam
+            t_start = time.time()
+            image = self.microscope.acquire_frame(self.resolution, self.dwell_time, self.bit_depth, square_area=True)
+            path = self.path + '/HAADF_' + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle))
+            frame = self.frames.publish(np.array(self.microscope.image_array(image)), path=path, tilt=tangle, beam_shift=self.microscope.beam_shift(), t_start=t_start)
+            if self.pipeline == True and self.drift_correction == True and self.drift_detector() != None:
+                img_drift, mid_strips = self.drift_frame(frame['image'])
+                features_pipeline.submit(path, self.microscope, img_drift, mid_strips, self.drift_resize_factor(), self.drift_detector(), self.denoiser)
+            return self.frame_to_save(image, frame), frame
+
+        def register(acquired):
+            try:
+                return self.drift_register(acquired[1])
+            except:
+                PrintException()
+                return None
+
+        def correct(match):
+            # A failed correction must not stop the series, the next acquisition only waits for it
+            if match != None:
+                try:
+                    self.drift_correct(match)
+                except:
+                    PrintException()
+
+        for i in range(1, nb_images+1):
+            while self.flag == 2:
+                time.sleep(0.1)
+            if self.flag == 1:
+                break
+
+            after = []
+            if i > 1:
+                graph.add('move_' + str(i), lambda *_: self.positioner.relative_move(0, 0, 0, self.direction*self.tilt_increment, 0), after=['acquire_' + str(i-1)])
+                graph.add('settle_' + str(i), lambda *_: time.sleep(self.settle_time), after=['move_' + str(i)])
+                after = ['settle_' + str(i), 'correct_' + str(i-1)]
+            graph.add('acquire_' + str(i), lambda *_, i=i: acquire(i), after=after)
+            # save_i overlaps acquire_i+1: the image to save is taken in acquire_i, the DM image is refilled by the next acquisition
+            graph.add('save_' + str(i), lambda acquired, *_: self.microscope.save(acquired[0], acquired[1]['path']), after=['acquire_' + str(i), 'save_' + str(i-1)])
+            if self.drift_correction == True:
+                graph.add('register_' + str(i), register, after=['acquire_' + str(i)])
+                graph.add('correct_' + str(i), correct, after=['register_' + str(i)])
+            # The stages of frame i-1 have all their dependents: their frames are not kept until the end of the series
+            graph.release(*[stage + '_' + str(i-1) for stage in ('move', 'settle', 'acquire', 'save', 'register', 'correct')])
+            try:
+                graph.wait('acquire_' + str(i))
+            except:
+                logging.info('Acquisition stopped at image ' + str(i))
+                break
+
+        for name in list(graph.stages):
+            try:
+                graph.wait(name)
+            except:
+                pass
+        graph.shutdown()
+        if len(graph.stages) > 0:
+            logging.info('mean stage durations ' + str({kind: round(duration, 3) for kind, duration in graph.summary().items()}))
+            logging.info('critical path ' + ' -> '.join(graph.critical_path()))
+        self.flag = 1
+        self.frames.close()
+        features_pipeline.shutdown()
+        logging.info('Tomography is a Success')
+        return 0
+
+    def drift_start(self):
+        ''' Reset the drift correction: no master frame, no accumulated correction.
+        '''
+        drift_prepare, drift_register = drift_backends[self.drift_backend]
+        logging.info('drift backend = ' + self.drift_backend)
+        if self.drift_detector() != None:
+            drift_prepare = partial(drift_prepare, denoiser=self.denoiser)
+            logging.info('denoiser = ' + self.denoiser)
+
+        resize_factor = self.drift_resize_factor()
+        logging.info('resize_factor = ' + number_format(resize_factor))
 
         # hfw = self.microscope.horizontal_field_view()
         # logging.info('hfw = ', number_format(hfw))
 
+        self.drift = {'prepare':        drift_prepare,
+                      'register':       drift_register,
+                      'resize_factor':  resize_factor,
+                      'master_index':   None,
+                      'anticipation_x': 0,
+                      'anticipation_y': 0,
+                      'correction_x':   0,
+                      'correction_y':   0}
+
+    def drift_register(self, frame) -> dict:
+        ''' Displacement of frame from the master frame, None if frame becomes the first master.
+        '''
+        drift = self.drift
+        if drift['master_index'] == None:
+            drift['beam_shift_previous'] = frame['beam_shift']
+            hfw = self.microscope.horizontal_field_view()
+            image_width, image_height = int(self.image_width), int(self.image_height)
+            logging.info('image_width = ' + number_format(image_width))
+            logging.info('image_height = ' + number_format(image_height))
+            dim_max = max(image_width, image_height)
+            dim_min = min(image_width, image_height)
+            logging.info('dim_max = ' + number_format(dim_max))
+            logging.info('dim_min = ' + number_format(dim_min))
+            logging.info('square = ' + str(self.square_area))
+            if self.square_area == True:
+                hfw = hfw*dim_min/dim_max
+            drift['img_master'], drift['mid_strips_master'] = self.drift_frame(frame['image'])
+            drift['state_master'] = drift['prepare'](self.microscope, drift['img_master'], drift['mid_strips_master'], drift['resize_factor'], frame_id=frame['path'])
+            drift['master_index'] = frame['index']
+            drift['hfw'], drift['image_width'], drift['image_height'] = hfw, image_width, image_height
+            logging.info('hfw = ' + number_format(hfw))
+            return None
+
+        img_template, mid_strips_template = self.drift_frame(frame['image'])
+        state_template = drift['prepare'](self.microscope, img_template, mid_strips_template, drift['resize_factor'], frame_id=frame['path'])
+
+        logging.info('mid_strips_master' + 'mid_strips_template ' + number_format(drift['mid_strips_master']) + ' ' + number_format(mid_strips_template))
+        dx_pix, dy_pix = drift['register'](img_template, drift['img_master'], state_template, drift['state_master'], drift['resize_factor'], mid_strips_template, drift['mid_strips_master'], path = self.path)
+        # blob_x_pix, blob_y_pix = blob_detection(img_template, mid_strips_template, resize_factor)
+        return {'frame':      frame,
+                'img':        img_template,
+                'mid_strips': mid_strips_template,
+                'state':      state_template,
+                'dx_pix':     dx_pix,
+                'dy_pix':     dy_pix}
+
+    def drift_correct(self, match):
+        ''' Beam shift correction from the displacement given by drift_register. The registered frame becomes the master.
+        '''
+        drift = self.drift
+        dx_pix, dy_pix = match['dx_pix'], match['dy_pix']
+        beam_shift_actual = match['frame']['beam_shift']
+        beam_shift_previous = drift['beam_shift_previous']
+        hfw = drift['hfw']
+        blob_x_pix = 0
+        blob_y_pix = 0
+
+        if self.microscope.microscope_type == 'ESEM':
+            beam_shift_difference = [beam_shift_actual[0] - beam_shift_previous[0], beam_shift_actual[1] - beam_shift_previous[1]]
+        else:
+            beam_shift_difference = [beam_shift_actual[0] - beam_shift_previous[0], beam_shift_actual[1] - beam_shift_previous[1]]
+
+        if self.microscope.microscope_type == 'ETEM':
+            beam_shift_difference[1] *= -1
+        # elif self.microscope.microscope_type == 'ESEM':
+        #     beam_shift_difference[0] *= -1
+        #     beam_shift_difference[1] *= -1
+        logging.info('beam shift prev' + str(beam_shift_previous))
+        logging.info('beam shift act' + str(beam_shift_actual))
+        logging.info('beam shift diff' + str(beam_shift_difference))
+
+        dx_si                    =   dx_pix * hfw / int(self.image_width) - beam_shift_difference[0]
+        dy_si                    =   dy_pix * hfw / int(self.image_width) - beam_shift_difference[1]
+        # blob_x_si                =   blob_x_pix * hfw / int(self.image_width)
+        # blob_y_si                =   blob_y_pix * hfw / int(self.image_width)
+
+        logging.info('dx_pix ' + number_format(dx_pix) + ' dy_pix ' + number_format(dy_pix))
+        logging.info('correction_x ' + number_format(drift['correction_x']))
+        logging.info('correction_y ' + number_format(drift['correction_y']))
+        drift['correction_x']    = - dx_si + drift['correction_x']
+        drift['correction_y']    = - dy_si + drift['correction_y']
+        drift['anticipation_x'] +=   drift['correction_x'] #- blob_x_si
+        drift['anticipation_y'] +=   drift['correction_y'] #- blob_y_si
+        correction_x, correction_y     = drift['correction_x'], drift['correction_y']
+        anticipation_x, anticipation_y = drift['anticipation_x'], drift['anticipation_y']
+
+        #logging.info('blob_x', 'blob_y', blob_x_pix, blob_y_pix)
+
+        if (dx_pix != 0 and dy_pix != 0): #or (blob_x_pix != 0 and blob_y_pix != 0):
+            if (dx_pix < drift['image_width'] and dy_pix < drift['image_height']):
+                value_x = correction_x + anticipation_x
+                value_y = correction_y + anticipation_y
+                logging.info('dx_pix ' + number_format(dx_pix) + ' dy_pix ' + number_format(dy_pix))
+                logging.info('dx_si ' + number_format(dx_si) + ' dy_si ' + number_format(dy_si))
+                logging.info('correction_x ' + number_format(correction_x) + ' correction_y ' + number_format(correction_y))
+                logging.info('anticipation_x ' + number_format(anticipation_x) + ' anticipation_y ' + number_format(anticipation_y))
+                logging.info('value_x, value_y ' + number_format(value_x) + number_format(value_y))
+
+                if self.microscope.microscope_type == 'ESEM':
+                    self.microscope.beam_shift(value_x, value_y, mode = 'rel')
+                else:
+                    self.microscope.beam_shift(value_x, -value_y, mode = 'rel')
+                logging.info('Correction Done')
+            else:
+                logging.info('/!\\ Drift is not correctly handled!')
+        else:
+            value_x, value_y = 0, 0
+
+        if self.microscope.microscope_type == 'ESEM':
+            drift['beam_shift_previous'] = beam_shift_actual[0] + value_x, beam_shift_actual[1] + value_y
+        else:
+            drift['beam_shift_previous'] = beam_shift_actual[0] + value_x, beam_shift_actual[1] - value_y
+
+        drift['mid_strips_master'] = match['mid_strips']
+        drift['state_master']      = match['state']
+        drift['img_master']        = match['img']
+        drift['master_index']      = match['frame']['index']
+
+    def f_drift_correction(self):
+        ''' Registration of each frame against the previous one and beam shift correction.
+
+        With pipeline, frame N is registered while frame N+1 is acquired: the acquisition loop only waits
+        for the frame to be taken. The correction computed from frame N is applied once frame N+1 is
+        acquired, between two frames, the beam shift of frame N+1 accounts for it.
+        '''
+        if self.scheduler == True:
+            return # registration and correction are stages of tomo_graph
+        self.c.acquire()
+        self.drift_start()
+
         while True:
             if self.flag == 1:
+                logging.info('match quality per denoiser ' + str(match_quality.summary()))
                 self.c.notify_all()
                 self.c.release()
                 return
             if self.flag == 2:
                 self.c.wait()
 
-            # Load two most recent images
-            list_of_imgs  = [file for file in os.listdir(self.path) if '.tif' or '.dm4' in file]
-            if len(list_of_imgs) == 0:
-                self.c.notify_all()
-                self.c.wait()
-                continue
-            if len(list_of_imgs) == 1:
-                beam_shift_previous = self.microscope.beam_shift()
-                hfw = self.microscope.horizontal_field_view()
-                img_prev_path = list_of_imgs[0]
-                img_prev  = self.microscope.load(self.path + '/' + img_prev_path)
-                image_width, image_height = int(self.image_width), int(self.image_height)
-                logging.info('image_width = ' + number_format(image_width))
-                logging.info('image_height = ' + number_format(image_height))
-                dim_max = max(image_width, image_height)
-                dim_min = min(image_width, image_height)
-                logging.info('dim_max = ' + number_format(dim_max))
-                logging.info('dim_min = ' + number_format(dim_min))
-                logging.info('square = ' + str(self.square_area))
-                if self.square_area == True:
-                    img_prev = img_prev[0:dim_max, (dim_max - dim_min)//2:(dim_max + dim_min)//2]
-                    hfw = hfw*dim_min/dim_max
-                img_master, mid_strips_master = remove_strips(self.microscope, img_prev, self.dwell_time)
-                kp2, des2 = match_by_features_SIFT_create(self.microscope, img_master, mid_strips_master, resize_factor)
-                self.c.notify_all()
-                self.c.wait()
-                logging.info('hfw = ' + number_format(hfw))
-                continue
-            
-            beam_shift_actual = self.microscope.beam_shift()
-            img_path = max(list_of_imgs, key=lambda fn:os.path.getmtime(os.path.join(self.path, fn)))
-            img = self.microscope.load(self.path + '/' + img_path)
-            if self.square_area == True:
-                    img = img[0:dim_max, (dim_max - dim_min)//2:(dim_max + dim_min)//2]
-            img_template, mid_strips_template = remove_strips(self.microscope, img, self.dwell_time)
-            kp1, des1 = match_by_features_SIFT_create(self.microscope, img_template, mid_strips_template, resize_factor)
-            
-            logging.info('mid_strips_master' + 'mid_strips_template ' + number_format(mid_strips_master) + ' ' + number_format(mid_strips_template))
-            dx_pix, dy_pix = match_by_features(img_template, img_master, kp1, des1, kp2, des2, resize_factor, mid_strips_template, mid_strips_master, path = self.path)
-            # blob_x_pix, blob_y_pix = blob_detection(img_template, mid_strips_template, resize_factor)
-            blob_x_pix = 0
-            blob_y_pix = 0
-
-            if self.microscope.microscope_type == 'ESEM':
-                beam_shift_difference = [beam_shift_actual[0] - beam_shift_previous[0], beam_shift_actual[1] - beam_shift_previous[1]]
-            else:
-                beam_shift_difference = [beam_shift_actual[0] - beam_shift_previous[0], beam_shift_actual[1] - beam_shift_previous[1]]
-
-            if self.microscope.microscope_type == 'ETEM':
-                beam_shift_difference[1] *= -1
-            # elif self.microscope.microscope_type == 'ESEM':
-            #     beam_shift_difference[0] *= -1
-            #     beam_shift_difference[1] *= -1
-            logging.info('beam shift prev' + str(beam_shift_previous))
-            logging.info('beam shift act' + str(beam_shift_actual))
-            logging.info('beam shift diff' + str(beam_shift_difference))
-    
-            dx_si                    =   dx_pix * hfw / int(self.image_width) - beam_shift_difference[0]
-            dy_si                    =   dy_pix * hfw / int(self.image_width) - beam_shift_difference[1]
-            # blob_x_si                =   blob_x_pix * hfw / int(self.image_width)
-            # blob_y_si                =   blob_y_pix * hfw / int(self.image_width)
-
-            logging.info('dx_pix ' + number_format(dx_pix) + ' dy_pix ' + number_format(dy_pix))
-            logging.info('correction_x ' + number_format(correction_x))
-            logging.info('correction_y ' + number_format(correction_y))
-            correction_x             = - dx_si + correction_x
-            correction_y             = - dy_si + correction_y
-            anticipation_x          +=   correction_x #- blob_x_si
-            anticipation_y          +=   correction_y #- blob_y_si
-            
-            #logging.info('blob_x', 'blob_y', blob_x_pix, blob_y_pix)
-            
-            if (dx_pix != 0 and dy_pix != 0): #or (blob_x_pix != 0 and blob_y_pix != 0):
-                if (dx_pix < image_width and dy_pix < image_height):
-                    value_x = correction_x + anticipation_x
-                    value_y = correction_y + anticipation_y
-                    logging.info('dx_pix ' + number_format(dx_pix) + ' dy_pix ' + number_format(dy_pix))
-                    logging.info('dx_si ' + number_format(dx_si) + ' dy_si ' + number_format(dy_si))
-                    logging.info('correction_x ' + number_format(correction_x) + ' correction_y ' + number_format(correction_y))
-                    logging.info('anticipation_x ' + number_format(anticipation_x) + ' anticipation_y ' + number_format(anticipation_y))
-                    logging.info('value_x, value_y ' + number_format(value_x) + number_format(value_y))
-                    
-                    if self.microscope.microscope_type == 'ESEM':
-                        self.microscope.beam_shift(value_x, value_y, mode = 'rel')
-                    else:
-                        self.microscope.beam_shift(value_x, -value_y, mode = 'rel')
-                    logging.info('Correction Done')
-                else:
-                    logging.info('/!\ Drift is not correctly handled!')
-            else:
-                value_x, value_y = 0, 0
-            
-            if self.microscope.microscope_type == 'ESEM':
-                beam_shift_previous = beam_shift_actual[0] + value_x, beam_shift_actual[1] + value_y
-            else:
-                beam_shift_previous = beam_shift_actual[0] + value_x, beam_shift_actual[1] - value_y
-
-            mid_strips_master = deepcopy(mid_strips_template)
-            kp2 = cv2_copy(kp1)
-            des2 = deepcopy(des1)
-            img_master = deepcopy(img_template)
+            # Most recent frame, the first one is the master
+            frame = self.frames.latest()
+            if frame != None and frame['index'] != self.drift['master_index']:
+                if self.pipeline == True:
+                    self.c.notify_all()
+                    self.c.release()
+                    match = self.drift_register(frame)
+                    self.c.acquire() # the acquisition loop waits between two frames, with frame N+1 published
+                    if match != None:
+                        self.drift_correct(match)
+                    continue
+                match = self.drift_register(frame)
+                if match != None:
+                    self.drift_correct(match)
 
             self.c.notify_all()
             self.c.wait()
-            continue
 
     def f_focus_correction(self, appPI):
         '''
         '''
-        img_path_0 = ''
+        last_index = -1
         focus_tollerance = 0.95
         averaging = 2
         focus_score_list = []*averaging
@@ -1028,17 +2317,11 @@ class acquisition(object):
             for i in range(averaging):
                 if self.flag == 1:
                     return
-                try:
-                    list_of_imgs = os.listdir(self.path)
-                    img_path     = max(list_of_imgs, key=lambda fn:os.path.getmtime(os.path.join(self.path, fn)))
-                    if img_path == img_path_0:
-                        continue
-                    else:
-                        img_path_0 = deepcopy(img_path)
-                    img = imread(self.path + '/' + img_path)
-                except:
-                    time.sleep(0.1)
+                frame = self.frames.wait(after=last_index, timeout=0.1)
+                if frame == None:
                     continue
+                last_index = frame['index']
+                img = frame['image']
                 
                 # # STDEV
                 # noise_level         = np.mean(img[img<self.dtype_number//2])
@@ -1098,6 +2381,7 @@ class acquisition(object):
         '''
         self.c.acquire()
         self.microscope.start_acquisition()
+        writer = self.start_writer()
         
         if self.microscope.microscope_type == 'ESEM':
             self.microscope.tilt_correction(ONOFF=True)
@@ -1112,7 +2396,7 @@ class acquisition(object):
             if self.flag == 2:
                 self.c.wait()
 
-            pos = self.positioner.current_position()
+            pos = self.positioner.position()
             
             tangle = pos[3]
             
@@ -1121,13 +2405,15 @@ class acquisition(object):
 
             # logging.info(str(i) + str(self.positioner.getpos()[2]))
             
+            t_start = time.time()
             images = self.microscope.acquire_frame(self.resolution, self.dwell_time, self.bit_depth)
             
             # images[0].save(self.path + '/SE_'    + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle)) + '.tif')
             # images[1].save(self.path + '/BF_'    + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle)) + '.tif')
 
             path = self.path + '/HAADF_' + str(self.images_name) + '_' + str(i) + '_' + str(round(tangle))
-            self.microscope.save(images, path)
+            frame = self.frames.publish(np.array(self.microscope.image_array(images)), path=path, tilt=tangle, beam_shift=self.microscope.beam_shift(), t_start=t_start)
+            writer.submit(self.frame_to_save(images, frame), path)
             
             i += 1
             if self.drift_correction == True or self.focus_correction == True:
@@ -1137,23 +2423,17 @@ class acquisition(object):
     def f_image_fft(self, appPI):
         '''
         '''
-        img_path_0 = ''
+        last_index = -1
         i = 0
         while True:
             if self.flag == 1:
                 return
             try:
-                list_of_imgs = os.listdir(self.path)
-                img_path     = max(list_of_imgs, key=lambda fn:os.path.getmtime(os.path.join(self.path, fn)))
-                if img_path == img_path_0:
+                frame = self.frames.wait(after=last_index, timeout=0.1)
+                if frame == None:
                     continue
-                else:
-                    img_path_0 = deepcopy(img_path)
-                
-                if self.microscope.microscope_type == 'ESEM':
-                    img = self.microscope.load(self.path + '/' + img_path)
-                else:
-                    img = imread(self.path + '/' + img_path)
+                last_index = frame['index']
+                img = frame['image']
                 
                 image_height, image_width  = img.shape
                 img = img[:,(image_width-image_height)//2:(image_width+image_height)//2]
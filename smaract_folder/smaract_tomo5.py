@@ -2,6 +2,7 @@ import logging
 import sys
 import smaract.ctl as ctl
 import ctypes
+import time
 from typing import List
 vector = List[int]
 
@@ -56,25 +57,50 @@ class smaract_class(object):
         else:
             return False
         
-    def hold_during_move(self) -> ctypes.c_uint32:
-        ''' Hold instruction flow during movement of positioners.
+    def moving(self, channels=(0, 1, 2)) -> List[int]:
+        ''' Channels still actively moving among the given ones (one CHANNEL_STATE read per channel).
+        '''
+        mask = ctl.ChannelState.ACTIVELY_MOVING
+        return [channel for channel in channels if ctl.GetProperty_i32(self.d_handle, channel, ctl.Property.CHANNEL_STATE) & mask]
+
+    def hold_during_move(self, channels=(0, 1, 2), timeout=None) -> int:
+        ''' Hold instruction flow until the movement of the given channels is finished.
+
+        Waits on the MCS2 events (MOVEMENT_FINISHED) instead of polling. A finished event is
+        confirmed by the channel state, as it may be left over from an earlier non-blocking move.
+        Without event API, or when no event comes within 100 ms, the channel states are polled
+        with a sleep growing from 1 ms to 50 ms.
 
         Input:
-            - self (class).
+            - channels: channels to wait for, 0 (t), 1 (z), 2 (y), 3 and 4 (detector) (tuple[int]).
+            - timeout: maximum wait in s, None for no limit (float).
 
         Return:
-            - status code given by SA_GetStatus_S() for z, y and t (ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint32).
+            - 0 when all the channels stopped, 1 on timeout (int).
         
         Exemple:
-            z_status_status, y_status_status, t_status_status = self.hold_during_move()
+            smaract.hold_during_move(channels=(0,))
+                -> Wait for the tilt only
         '''
-        while (True):
-            mask = ctl.ChannelState.ACTIVELY_MOVING
-            state1 = ctl.GetProperty_i32(self.d_handle, 0, ctl.Property.CHANNEL_STATE)
-            state2 = ctl.GetProperty_i32(self.d_handle, 1, ctl.Property.CHANNEL_STATE)
-            state3 = ctl.GetProperty_i32(self.d_handle, 2, ctl.Property.CHANNEL_STATE)
-            if (state1 & mask) == 0 and (state2 & mask) == 0 and (state3 & mask) == 0:
-                break
+        t0 = time.perf_counter()
+        pending = self.moving(channels)
+        delay = 1e-3
+        while len(pending) > 0:
+            if timeout != None and time.perf_counter() - t0 > timeout:
+                logging.info('Timeout when waiting for channels ' + str(pending))
+                return 1
+            if hasattr(ctl, 'WaitForEvent'):
+                try:
+                    event = ctl.WaitForEvent(self.d_handle, 100)
+                    if event.type == ctl.EventType.MOVEMENT_FINISHED and event.idx in pending and len(self.moving([event.idx])) == 0:
+                        pending.remove(event.idx)
+                    continue
+                except ctl.Error:
+                    pass # timeout: fall back on the channel states
+            else:
+                time.sleep(delay)
+                delay = min(2*delay, 50e-3)
+            pending = self.moving(pending)
         return 0
 
     def getpos(self) -> vector:
@@ -90,9 +116,9 @@ class smaract_class(object):
             [z, y, t] = smaract.getpos()
         '''
         try:
-            z_pos = ctl.GetProperty_i64(self.d_handle, 1, ctl.Property.POSITION)*1e-3
-            y_pos = ctl.GetProperty_i64(self.d_handle, 2, ctl.Property.POSITION)*1e-3
-            t_angle = ctl.GetProperty_i64(self.d_handle, 0, ctl.Property.POSITION)*1e-3
+            # Batched read: the three requests are sent before the first answer is awaited
+            requests = [ctl.RequestReadProperty(self.d_handle, channel, ctl.Property.POSITION, 0) for channel in (1, 2, 0)]
+            z_pos, y_pos, t_angle = [ctl.ReadProperty_i64(self.d_handle, r_id)*1e-3 for r_id in requests]
         except:
             logging.info('Error when acquiring positions')
             return [None, None, None]
@@ -147,7 +173,7 @@ class smaract_class(object):
         #     return 1
 
         if hold == True:
-            self.hold_during_move()
+            self.hold_during_move((1, 2, 0))
             logging.info('Position set at: ' + str([pos[0], pos[1], pos[2]]))
         else:
             logging.info('Position set at: ' + str([pos[0], pos[1], pos[2]]))
@@ -175,7 +201,7 @@ class smaract_class(object):
         #     return 1
 
         if hold == True:
-            self.hold_during_move()
+            self.hold_during_move((3, 4))
             logging.info('Position set at: ' + str([pos[0], pos[1]]))
         else:
             logging.info('Position set at: ' + str([pos[0], pos[1]]))
@@ -206,16 +232,18 @@ class smaract_class(object):
             logging.info('Error when checking limits')
             return 1
     
+        # Only the axes with a step are moved and waited for
+        channels = [channel for channel, dp in zip((1, 2, 0), step) if dp != 0]
         try:
-            ctl.Move(self.d_handle, 1, int(pos2[0]*1e3), 0)
-            ctl.Move(self.d_handle, 2, int(pos2[1]*1e3), 0)
-            ctl.Move(self.d_handle, 0, int(pos2[2]*1e3), 0)
+            for channel, p in zip((1, 2, 0), pos2):
+                if channel in channels:
+                    ctl.Move(self.d_handle, channel, int(p*1e3), 0)
         except:
             logging.info('Error when setting relative position.')
             return 1
 
         if hold == True:
-            self.hold_during_move()
+            self.hold_during_move(channels)
             logging.info('Position increased of: ' + str([step[0], step[1], step[2]]))
         else:
             logging.info('Position increasing of: ' + str([step[0], step[1], step[2]]))
@@ -234,20 +262,50 @@ class smaract_class(object):
             logging.info('Error when checking limits')
             return 1
     
+        channels = [channel for channel, dp in zip((3, 4), step) if dp != 0]
         try:
-            ctl.Move(self.d_handle, 3, int(pos2[0]*1e3), 0)
-            ctl.Move(self.d_handle, 4, int(pos2[1]*1e3), 0)
+            for channel, p in zip((3, 4), pos2):
+                if channel in channels:
+                    ctl.Move(self.d_handle, channel, int(p*1e3), 0)
         except:
             logging.info('Error when setting relative position.')
             return 1
 
         if hold == True:
-            self.hold_during_move()
+            self.hold_during_move(channels)
             logging.info('Position increased of: ' + str([step[0], step[1]]))
         else:
             logging.info('Position increasing of: ' + str([step[0], step[1]]))
         return 0
     
+    def setpos_tilt(self, angle, hold=True) -> int:
+        ''' Move the tilt channel (T) alone to an absolute angle in microdegrees.
+        '''
+        if not (self.range_limits['t_min'] <= angle <= self.range_limits['t_max']):
+            logging.info('Position out of range')
+            return 1
+        try:
+            ctl.Move(self.d_handle, 0, int(angle*1e3), 0)
+        except:
+            logging.info('Error when setting tilt angle.')
+            return 1
+        if hold == True:
+            self.hold_during_move((0,))
+        logging.info('Tilt set at: ' + str(angle))
+        return 0
+
+    def get_velocity(self, channel) -> int:
+        ''' Move velocity of a channel in pm/s or ndeg/s, 0 when velocity control is off.
+        '''
+        return ctl.GetProperty_i64(self.d_handle, channel, ctl.Property.MOVE_VELOCITY)
+
+    def set_velocity(self, channel, velocity):
+        ctl.SetProperty_i64(self.d_handle, channel, ctl.Property.MOVE_VELOCITY, int(velocity))
+
+    def stop(self, channels=(0, 1, 2)):
+        for channel in channels:
+            ctl.Stop(self.d_handle, channel)
+
     def set_zero_position(self, channel):
         ctl.SetProperty_i64(self.d_handle, channel, ctl.Property.POSITION, 0)
     
@@ -0,0 +1,123 @@
+'''
+Benchmark of the feature extractors used for drift correction.
+
+Replays the frames of a stored tilt series (data/tomo/<acquisition>/HAADF_*) and reports,
+for each detector of scripts_2.feature_detectors, each pre-match filter of scripts_2.denoisers
+and the ESEM (NL-means h=8) and ETEM (NL-means h=20) settings:
+    - extraction time (denoise + detect + describe),
+    - matching time (index + knn + RANSAC homography),
+    - displacement error on frames shifted by a known amount,
+    - success rate and error on consecutive frames, with the SIFT displacement as reference.
+
+Usage:
+    python test/benchmark_features.py [acquisition folder] [number of frames]
+'''
+import os
+import re
+import sys
+import time
+import tempfile
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scripts_2 as scripts
+from microscopes import DM34
+from tifffile import imread
+
+class microscope_type(object):
+    def __init__(self, microscope_type):
+        self.microscope_type = microscope_type
+
+def list_frames(folder):
+    frames = [f for f in os.listdir(folder) if f.endswith('.tif') or f.endswith('.dm4')]
+    # HAADF_<name>_<index>_<angle>.<ext>
+    return sorted(frames, key=lambda f: int(re.findall(r'_(-?\d+)_(-?\d+)\.', f)[-1][0]) if re.findall(r'_(-?\d+)_(-?\d+)\.', f) else 0)
+
+def load_frame(path):
+    if path.endswith('.dm4'):
+        img, _, _, _ = DM34.dm_load(path)
+    else:
+        img = imread(path)
+    img = np.asarray(img, dtype=np.float32)
+    return np.uint8(255*(img - img.min())/max(img.max() - img.min(), 1))
+
+def successes(denoiser):
+    # Matches with enough RANSAC inliers so far: a zero displacement is a valid match
+    return scripts.match_quality.stats.get(denoiser, {}).get('successes', 0)
+
+def shift_frame(img, shift_x, shift_y):
+    M = np.float32([[1, 0, shift_x], [0, 1, shift_y]])
+    return cv.warpAffine(img, M, (img.shape[1], img.shape[0]), flags=cv.INTER_LINEAR, borderMode=cv.BORDER_REFLECT)
+
+def run(folder, nb_frames=20, resize=410):
+    frames = list_frames(folder)[:nb_frames]
+    if len(frames) < 2:
+        print('Not enough frames in', folder)
+        return
+    imgs = [load_frame(os.path.join(folder, f)) for f in frames]
+    resize_factor = resize/float(imgs[0].shape[1])
+    path = tempfile.mkdtemp()
+    scripts.diagnostics.configure(mode='off') # match images would compete with the timed code
+    rng = np.random.default_rng(0)
+    shifts = rng.uniform(-30, 30, (len(imgs), 2))
+
+    print('{} frames of {} from {}, resize factor {:.3f}'.format(len(imgs), imgs[0].shape, folder, resize_factor))
+    print('{:6} {:10} {:6} {:>10} {:>10} {:>12} {:>10} {:>12}'.format('type', 'denoiser', 'det', 'extract ms', 'match ms', 'shift err px', 'pairs ok', 'pair err px'))
+
+    for micro_type, denoiser in [(t, d) for t in ('ESEM', 'ETEM') for d in scripts.denoisers if t == 'ESEM' or d == 'nlmeans']:
+        micro = microscope_type(micro_type)
+        reference = []
+        for detector in scripts.feature_detectors:
+            t_extract, t_match, err_shift, err_pair, ok_pair = [], [], [], [], 0
+            features = []
+            for k, img in enumerate(imgs):
+                t0 = time.perf_counter()
+                features.append(scripts.match_by_features_create(micro, img, 0, resize_factor, detector, denoiser))
+                t_extract.append(time.perf_counter() - t0)
+
+                # Same frame shifted by a known amount: ground truth
+                img_shift = shift_frame(img, *shifts[k])
+                kp, des = scripts.match_by_features_create(micro, img_shift, 0, resize_factor, detector, denoiser)
+                before = successes(denoiser)
+                t0 = time.perf_counter()
+                dx, dy = scripts.match_by_features(img_shift, img, kp, des, *features[k], resize_factor, 0, 0, path=path, denoiser=denoiser)
+                t_match.append(time.perf_counter() - t0)
+                if successes(denoiser) > before:
+                    err_shift.append(np.hypot(dx - shifts[k][0], dy + shifts[k][1]))
+
+            # Consecutive frames of the series, SIFT as reference
+            for k in range(1, len(imgs)):
+                before = successes(denoiser)
+                dx, dy = scripts.match_by_features(imgs[k], imgs[k-1], *features[k], *features[k-1], resize_factor, 0, 0, path=path, denoiser=denoiser)
+                success = successes(denoiser) > before
+                if detector == 'SIFT':
+                    reference.append((dx, dy) if success else None)
+                if success:
+                    ok_pair += 1
+                    if reference[k-1] != None:
+                        err_pair.append(np.hypot(dx - reference[k-1][0], dy - reference[k-1][1]))
+
+            print('{:6} {:10} {:6} {:10.1f} {:10.1f} {:12.2f} {:>10} {:12.2f}'.format(
+                micro_type, denoiser, detector,
+                1e3*np.mean(t_extract), 1e3*np.mean(t_match),
+                np.mean(err_shift) if err_shift else np.nan,
+                '{}/{}'.format(ok_pair, len(imgs) - 1),
+                np.mean(err_pair) if err_pair else np.nan))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        folder = sys.argv[1]
+    else:
+        acquisitions = [os.path.join('data/tomo', d) for d in os.listdir('data/tomo') if os.path.isdir(os.path.join('data/tomo', d))]
+        if len(acquisitions) == 0:
+            print('No acquisition in data/tomo')
+            exit(0)
+        folder = max(acquisitions, key=os.path.getmtime)
+    nb_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    run(folder, nb_frames)
+    print('match quality per denoiser (known shifts and consecutive frames):')
+    for denoiser, stats in scripts.match_quality.summary().items():
+        print('{:10} {}'.format(denoiser, stats))
@@ -0,0 +1,58 @@
+'''
+Round trip of a tilt series written frame by frame with DM34.dm_stack.
+
+Usage:
+    python -m pytest test/test_dm_stack.py
+'''
+import os
+import sys
+import filecmp
+import tempfile
+import numpy as np
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from microscopes import DM34
+
+def tilt_series(n_frames=40, height=64, width=48, seed=0):
+    rng = np.random.default_rng(seed)
+    frames = rng.integers(0, 65535, (n_frames, height, width)).astype(np.uint16)
+    angles = np.linspace(-60, 60, n_frames)
+    return frames, angles
+
+def test_stack_round_trip():
+    frames, angles = tilt_series()
+    n_frames, height, width = frames.shape
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'stack.dm4')
+
+    stack = DM34.dm_stack(path, (height, width), np.uint16, chunk=16, meta={'Name': 'tomo'})
+    for k in range(n_frames):
+        stack.append(frames[k], angles[k])
+        if k == 20:
+            # Valid file mid-series, the reserved chunk stays on disk
+            size = os.path.getsize(path)
+            stack.flush()
+            assert os.path.getsize(path) >= size
+            image, _, _, meta = DM34.dm_load(path)
+            assert np.array_equal(image, frames[:21])
+            assert np.allclose(meta['Tilt angles'], angles[:21], atol=1e-4)
+    stack.close()
+
+    image, dimensions, _, meta = DM34.dm_load(path)
+    assert image.shape == (n_frames, height, width)
+    assert np.array_equal(image, frames)
+    assert (int(dimensions['0']), int(dimensions['1']), int(dimensions['2'])) == (width, height, n_frames)
+    assert np.allclose(meta['Tilt angles'], angles, atol=1e-4)
+    assert meta['Name'] == 'tomo'
+    assert np.array_equal(DM34.dm_load(path, mmap=True)[0][5], frames[5])
+
+    # Same file as the whole stack stored at once
+    path_full = os.path.join(folder, 'full.dm4')
+    DM34.dm_store(path_full, frames, {'0': width, '1': height, '2': n_frames}, 'dm4',
+                  meta={'Name': 'tomo', 'Tilt angles': angles.astype(np.float32)})
+    assert filecmp.cmp(path, path_full, shallow=False)
+
+if __name__ == "__main__":
+    test_stack_round_trip()
+    print('ok')
@@ -0,0 +1,59 @@
+'''
+Coarse-to-fine search of scripts_2.match against the full resolution search.
+
+At grid_size=16 the patches of the blurred frames are small: the coarse search must give
+the same displacement as coarse_factor=1 (exhaustive search at full resolution).
+
+Usage:
+    python -m pytest test/test_match_grid.py
+'''
+import os
+import sys
+import numpy as np
+import cv2 as cv
+
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scripts_2 as scripts
+
+def synthetic_frame(height=1024, width=1536, seed=0):
+    rng = np.random.default_rng(seed)
+    img = cv.GaussianBlur((rng.random((height, width))*255).astype(np.uint8), (7, 7), 0)
+    return cv.normalize(img, None, 0, 255, cv.NORM_MINMAX)
+
+def shift_frame(img, shift_x, shift_y):
+    M = np.float32([[1, 0, shift_x], [0, 1, shift_y]])
+    return cv.warpAffine(img, M, (img.shape[1], img.shape[0]))
+
+def test_coarse_matches_full_resolution_grid_16():
+    img = synthetic_frame()
+    for shift in [(10, 0), (10, 10), (-25, 13)]:
+        img_shift = shift_frame(img, *shift)
+        dx_coarse, dy_coarse, _ = scripts.match(img, img_shift, grid_size=16)
+        dx_full,   dy_full,   _ = scripts.match(img, img_shift, grid_size=16, coarse_factor=1)
+        assert abs(dx_coarse - dx_full) < 0.5, (shift, dx_coarse, dx_full)
+        assert abs(dy_coarse - dy_full) < 0.5, (shift, dy_coarse, dy_full)
+
+def test_coarse_patches_grid_16():
+    # Best location of every patch, coarse against exhaustive
+    n = 51
+    img_master   = cv.GaussianBlur(synthetic_frame(), (n, n), 0)
+    img_template = cv.GaussianBlur(shift_frame(synthetic_frame(), 10, 10), (n, n), 0)
+    height, width = img_master.shape
+    grid_size = 16
+    height_template, width_template = int(0.9*height), int(0.9*width)
+    patch_size = (height_template//grid_size, width_template//grid_size)
+    patch_xA = (height - height_template)//2 + np.arange(grid_size)*patch_size[0]
+    patch_yA = (width  - width_template)//2  + np.arange(grid_size)*patch_size[1]
+    patch_xA, patch_yA = [a.ravel() for a in np.meshgrid(patch_xA, patch_yA, indexing='ij')]
+
+    full_x, full_y, _     = scripts.match_grid_fft(img_master, img_template, patch_xA, patch_yA, patch_size, 1)
+    coarse_x, coarse_y, _ = scripts.match_grid_fft(img_master, img_template, patch_xA, patch_yA, patch_size, 4)
+    distance = np.hypot(coarse_x - full_x, coarse_y - full_y)
+    assert np.max(distance) <= 3, np.max(distance)
+    assert np.mean(distance == 0) > 0.95, np.mean(distance == 0)
+
+if __name__ == "__main__":
+    test_coarse_matches_full_resolution_grid_16()
+    test_coarse_patches_grid_16()
+    print('ok')